@@ -0,0 +1,567 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Distributed backtest job queue.
+
+A coordinator holds a queue of backtest jobs (Moonshot strategies such as
+dma-tech or umd-demo, zipline algorithms, or arbitrary commands such as the
+backtrader script) and hands them out to workers running on any number of
+machines. Coordinator and workers talk over TCP using newline-delimited
+JSON messages:
+
+    worker -> coordinator   {"type": "hello", "worker_id": ..., "cached_dbs": [...], "token": ...}
+    worker -> coordinator   {"type": "request"}
+    coordinator -> worker   {"type": "job", "job": {...}, "heartbeat_interval": ...}
+                            {"type": "wait", "seconds": ...}
+                            {"type": "shutdown"}
+    worker -> coordinator   {"type": "heartbeat", "job_id": ...}
+    worker -> coordinator   {"type": "result", "job_id": ..., "status": "ok"|"error", ...}
+    coordinator -> worker   {"type": "error", "error": ...}
+
+A connection must start with hello, may only request a job when it has none
+running, and may only send heartbeats and results for the job it was given.
+Any other message gets an error reply and the connection is closed (and its
+job re-queued). If the coordinator is given a token, hello must carry the
+same token. Workers run whatever commands the coordinator sends, so the
+coordinator listens on 127.0.0.1 unless told otherwise; set a token when
+listening on other interfaces.
+
+When a worker asks for a job, the coordinator prefers the oldest pending job
+whose "db" the worker already has cached (workers announce their cached DBs
+and gain each DB they run a job for), and otherwise hands out the oldest
+pending job. Workers send heartbeats while a job runs; if a worker
+disconnects or misses heartbeats for heartbeat_timeout seconds, its job is
+put back at the front of the queue, up to max_retries times.
+
+Results are compact JSON summaries (e.g. Sharpe, CAGR, max drawdown) rather
+than full backtest output.
+
+Jobs are dicts such as:
+
+    {"kind": "moonshot", "strategy": "dma-tech", "db": "tech-giants-1d",
+     "start_date": "2010-01-01", "params": {"SMAVG_WINDOW": 50}}
+    {"kind": "zipline", "algofile": "dual_moving_average.py", "bundle": "aapl-1d",
+     "start_date": "2010-01-01", "end_date": "2017-12-31"}
+    {"kind": "command", "command": ["python", "backtrader/dual_moving_average.py"]}
+
+Usage (everything can run on one box as separate processes):
+
+    python job_queue.py coordinator jobs.json --port 7777 --output results.json
+    python job_queue.py worker localhost:7777 --cached-dbs demo-stocks-1d,tech-giants-1d
+
+Across machines:
+
+    BACKTEST_FARM_TOKEN=secret python job_queue.py coordinator jobs.json --host 0.0.0.0
+    BACKTEST_FARM_TOKEN=secret python job_queue.py worker coordinator-host:7777
+"""
+
+import argparse
+import collections
+import hmac
+import importlib
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import subprocess
+import threading
+import time
+import uuid
+
+logger = logging.getLogger("backtest_farm.job_queue")
+
+def send_message(wfile, message):
+    wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+    wfile.flush()
+
+def read_message(rfile):
+    """
+    Reads one message, returning None if the connection was closed.
+    """
+    line = rfile.readline()
+    if not line:
+        return None
+    return json.loads(line.decode("utf-8"))
+
+class ProtocolError(Exception):
+    pass
+
+class _WorkerState(object):
+
+    def __init__(self, worker_id, cached_dbs):
+        self.worker_id = worker_id
+        self.cached_dbs = set(cached_dbs or [])
+        self.job_id = None
+
+class Coordinator(object):
+    """
+    Hands out jobs to workers and collects their results.
+
+    Parameters
+    ----------
+    jobs : list of dict, optional
+        jobs to enqueue
+
+    host : str
+        interface to listen on (default 127.0.0.1; use 0.0.0.0 to accept
+        workers on other machines)
+
+    port : int
+        port to listen on (default 0, any free port)
+
+    heartbeat_timeout : float
+        seconds without a message after which a worker is considered lost
+        (default 30)
+
+    max_retries : int
+        times a job is re-queued after its worker is lost (default 2)
+
+    token : str, optional
+        shared secret workers must send in their hello message
+    """
+
+    def __init__(self, jobs=None, host="127.0.0.1", port=0, heartbeat_timeout=30,
+                 max_retries=2, token=None):
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_retries = max_retries
+        self.token = token
+
+        self._lock = threading.Condition()
+        self._pending = collections.deque()
+        self._jobs = {}
+        self._attempts = collections.Counter()
+        self._running = {}
+        self._results = {}
+
+        for job in jobs or []:
+            self.submit(job)
+
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.request.settimeout(coordinator.heartbeat_timeout)
+                coordinator._serve_worker(self.rfile, self.wfile)
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def submit(self, job):
+        """
+        Enqueues a job and returns its job_id.
+        """
+        job = dict(job)
+        job.setdefault("job_id", uuid.uuid4().hex)
+        with self._lock:
+            self._jobs[job["job_id"]] = job
+            self._pending.append(job["job_id"])
+            self._lock.notify_all()
+        return job["job_id"]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def done(self):
+        return len(self._results) == len(self._jobs)
+
+    def wait(self, timeout=None):
+        """
+        Blocks until every job has a result and returns the results by
+        job_id.
+        """
+        deadline = time.time() + timeout if timeout else None
+        with self._lock:
+            while not self.done:
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    break
+                self._lock.wait(remaining)
+            return dict(self._results)
+
+    def _next_job(self, worker):
+        """
+        Pops the oldest pending job for the worker, preferring jobs whose DB
+        the worker has cached. Call with the lock held.
+        """
+        for job_id in self._pending:
+            if self._jobs[job_id].get("db") in worker.cached_dbs:
+                self._pending.remove(job_id)
+                return job_id
+        if self._pending:
+            return self._pending.popleft()
+        return None
+
+    def _requeue(self, worker):
+        """
+        Puts a lost worker's job back at the front of the queue. Call with
+        the lock held.
+        """
+        job_id = worker.job_id
+        if job_id is None or job_id in self._results:
+            return
+        self._running.pop(job_id, None)
+        self._attempts[job_id] += 1
+        if self._attempts[job_id] > self.max_retries:
+            logger.warning("job %s lost %d times, giving up", job_id, self._attempts[job_id])
+            self._results[job_id] = {
+                "job_id": job_id, "status": "lost", "worker_id": worker.worker_id}
+        else:
+            logger.warning("worker %s lost, re-queueing job %s", worker.worker_id, job_id)
+            self._pending.appendleft(job_id)
+        worker.job_id = None
+        self._lock.notify_all()
+
+    def _check_hello(self, message):
+        """
+        Returns the worker state for a hello message, raising ProtocolError
+        if it is malformed or has the wrong token.
+        """
+        if message.get("type") != "hello":
+            raise ProtocolError("expected hello, got {0}".format(message.get("type")))
+        worker_id = message.get("worker_id")
+        if not isinstance(worker_id, str) or not worker_id:
+            raise ProtocolError("hello is missing worker_id")
+        if self.token is not None and not hmac.compare_digest(
+                str(message.get("token") or ""), self.token):
+            raise ProtocolError("invalid token from worker {0}".format(worker_id))
+        cached_dbs = message.get("cached_dbs") or []
+        if not isinstance(cached_dbs, list):
+            raise ProtocolError("cached_dbs must be a list")
+        return _WorkerState(worker_id, cached_dbs)
+
+    def _check_job_id(self, worker, message):
+        """
+        Raises ProtocolError unless message refers to the worker's current
+        job.
+        """
+        if worker.job_id is None or message.get("job_id") != worker.job_id:
+            raise ProtocolError("worker {0} sent {1} for job {2} but is running {3}".format(
+                worker.worker_id, message["type"], message.get("job_id"), worker.job_id))
+
+    def _serve_worker(self, rfile, wfile):
+        worker = None
+        try:
+            while True:
+                message = read_message(rfile)
+                if message is None:
+                    break
+                if not isinstance(message, dict):
+                    raise ProtocolError("message is not a JSON object")
+
+                if worker is None:
+                    worker = self._check_hello(message)
+                    logger.info("worker %s connected (cached DBs: %s)",
+                                worker.worker_id, ", ".join(sorted(worker.cached_dbs)) or "none")
+                    continue
+
+                message_type = message.get("type")
+
+                if message_type == "request":
+                    if worker.job_id is not None:
+                        raise ProtocolError("worker {0} requested a job while running {1}".format(
+                            worker.worker_id, worker.job_id))
+                    with self._lock:
+                        job_id = self._next_job(worker)
+                        if job_id is not None:
+                            worker.job_id = job_id
+                            self._running[job_id] = worker.worker_id
+                            reply = {"type": "job", "job": self._jobs[job_id],
+                                     "heartbeat_interval": self.heartbeat_timeout / 3}
+                        elif self.done:
+                            reply = {"type": "shutdown"}
+                        else:
+                            # jobs are still running elsewhere and may be
+                            # re-queued
+                            reply = {"type": "wait", "seconds": 1}
+                    send_message(wfile, reply)
+
+                elif message_type == "heartbeat":
+                    self._check_job_id(worker, message)
+
+                elif message_type == "result":
+                    self._check_job_id(worker, message)
+                    job_id = message["job_id"]
+                    with self._lock:
+                        if job_id not in self._results:
+                            del message["type"]
+                            message["worker_id"] = worker.worker_id
+                            message["attempts"] = self._attempts[job_id] + 1
+                            self._results[job_id] = message
+                        self._running.pop(job_id, None)
+                        db = self._jobs[job_id].get("db")
+                        if db:
+                            worker.cached_dbs.add(db)
+                        worker.job_id = None
+                        self._lock.notify_all()
+
+                else:
+                    raise ProtocolError("unknown message type {0}".format(message_type))
+
+        except ProtocolError as e:
+            logger.warning("closing connection to worker %s: %s",
+                           worker.worker_id if worker else "(unknown)", e)
+            try:
+                send_message(wfile, {"type": "error", "error": str(e)})
+            except OSError:
+                pass
+        except (socket.timeout, OSError, ValueError) as e:
+            logger.warning("lost connection to worker %s: %s",
+                           worker.worker_id if worker else "(unknown)", e)
+        except Exception:
+            logger.exception("error serving worker %s",
+                             worker.worker_id if worker else "(unknown)")
+        finally:
+            if worker is not None:
+                with self._lock:
+                    self._requeue(worker)
+
+def _backtest_stats(returns):
+    """
+    Compact summary of a daily returns Series.
+    """
+    import numpy as np
+
+    returns = returns.fillna(0)
+    cum_returns = (1 + returns).cumprod()
+    num_years = len(returns) / 252
+    return {
+        "start_date": str(returns.index.min())[:10],
+        "end_date": str(returns.index.max())[:10],
+        "cagr": float(cum_returns.iloc[-1] ** (1 / num_years) - 1) if num_years else None,
+        "sharpe": float(returns.mean() / returns.std() * np.sqrt(252)) if returns.std() else None,
+        "max_drawdown": float((cum_returns / cum_returns.cummax() - 1).min()),
+    }
+
+def run_job(job):
+    """
+    Default job runner: runs a Moonshot backtest, zipline backtest or
+    command and returns a compact JSON-serializable summary.
+    """
+    kind = job.get("kind", "moonshot")
+
+    if kind == "moonshot":
+        import pandas as pd
+        from quantrocket.moonshot import backtest
+
+        f = io.StringIO()
+        backtest(
+            [job["strategy"]],
+            start_date=job.get("start_date"),
+            end_date=job.get("end_date"),
+            params=job.get("params"),
+            filepath_or_buffer=f)
+        f.seek(0)
+        results = pd.read_csv(f, parse_dates=["Date"], index_col=["Field", "Date"])
+        return _backtest_stats(results.loc["Return"][job["strategy"]])
+
+    if kind == "zipline":
+        import pandas as pd
+        from quantrocket.zipline import run_algorithm
+
+        f = io.StringIO()
+        run_algorithm(
+            job["algofile"],
+            data_frequency=job.get("data_frequency"),
+            capital_base=job.get("capital_base"),
+            bundle=job.get("bundle"),
+            start=job.get("start_date"),
+            end=job.get("end_date"),
+            filepath_or_buffer=f)
+        f.seek(0)
+        # the results CSV stacks several DataFrames; pull out the daily
+        # returns from the performance DataFrame
+        results = pd.read_csv(f)
+        returns = results.loc[
+            (results.dataframe == "perf") & (results.column == "returns")]
+        returns = pd.Series(
+            returns.value.astype(float).values, index=pd.to_datetime(returns["index"]))
+        return _backtest_stats(returns)
+
+    if kind == "command":
+        completed = subprocess.run(job["command"], capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError("command exited {0}: {1}".format(
+                completed.returncode, completed.stderr[-1000:]))
+        return {"returncode": completed.returncode, "stdout": completed.stdout[-1000:]}
+
+    raise ValueError("unknown job kind: {0}".format(kind))
+
+class Worker(object):
+    """
+    Pulls jobs from a coordinator and runs them.
+
+    Parameters
+    ----------
+    address : tuple of (str, int)
+        the coordinator's host and port
+
+    worker_id : str, optional
+        unique name of the worker (default hostname and pid)
+
+    cached_dbs : list of str, optional
+        DBs the worker already has in its local caches
+
+    runner : callable
+        function called with each job dict, returning a JSON-serializable
+        result (default run_job)
+
+    token : str, optional
+        shared secret expected by the coordinator
+    """
+
+    def __init__(self, address, worker_id=None, cached_dbs=None, runner=run_job, token=None):
+        self.address = address
+        self.worker_id = worker_id or "{0}-{1}".format(socket.gethostname(), os.getpid())
+        self.cached_dbs = list(cached_dbs or [])
+        self.runner = runner
+        self.token = token
+        self._write_lock = threading.Lock()
+
+    def _send(self, wfile, message):
+        with self._write_lock:
+            send_message(wfile, message)
+
+    def _heartbeat(self, wfile, job_id, interval, stop):
+        while not stop.wait(interval):
+            try:
+                self._send(wfile, {"type": "heartbeat", "job_id": job_id})
+            except OSError:
+                return
+
+    def run(self):
+        """
+        Runs jobs until the coordinator has none left. Raises
+        RuntimeError if the coordinator rejects a message.
+        """
+        sock = socket.create_connection(self.address)
+        rfile = sock.makefile("rb")
+        wfile = sock.makefile("wb")
+        try:
+            self._send(wfile, {
+                "type": "hello", "worker_id": self.worker_id, "cached_dbs": self.cached_dbs,
+                "token": self.token})
+
+            while True:
+                self._send(wfile, {"type": "request"})
+                message = read_message(rfile)
+                if message is None or message["type"] == "shutdown":
+                    return
+                if message["type"] == "error":
+                    raise RuntimeError("coordinator rejected worker {0}: {1}".format(
+                        self.worker_id, message["error"]))
+                if message["type"] == "wait":
+                    time.sleep(message["seconds"])
+                    continue
+
+                job = message["job"]
+                logger.info("running job %s", job["job_id"])
+
+                stop = threading.Event()
+                heartbeat = threading.Thread(
+                    target=self._heartbeat, args=(wfile, job["job_id"], message["heartbeat_interval"], stop))
+                heartbeat.daemon = True
+                heartbeat.start()
+                try:
+                    result = {"type": "result", "job_id": job["job_id"], "status": "ok",
+                              "result": self.runner(job)}
+                except Exception as e:
+                    logger.exception("job %s failed", job["job_id"])
+                    result = {"type": "result", "job_id": job["job_id"], "status": "error",
+                              "error": repr(e)}
+                finally:
+                    stop.set()
+                    heartbeat.join()
+
+                self._send(wfile, result)
+        finally:
+            sock.close()
+
+def _load_runner(path):
+    module_name, func_name = path.split(":")
+    return getattr(importlib.import_module(module_name), func_name)
+
+def main():
+    parser = argparse.ArgumentParser(description="distributed backtest job queue")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    coordinator_parser = subparsers.add_parser("coordinator", help="serve a queue of jobs to workers")
+    coordinator_parser.add_argument("jobs", help="JSON file containing a list of jobs")
+    coordinator_parser.add_argument("--host", default="127.0.0.1",
+                                    help="interface to listen on (default 127.0.0.1; use 0.0.0.0 "
+                                    "with a token to accept workers on other machines)")
+    coordinator_parser.add_argument("--port", type=int, default=7777, help="port to listen on (default 7777)")
+    coordinator_parser.add_argument("--heartbeat-timeout", type=float, default=30,
+                                    help="seconds without heartbeat before a worker is considered lost (default 30)")
+    coordinator_parser.add_argument("--max-retries", type=int, default=2,
+                                    help="times to retry a job whose worker was lost (default 2)")
+    coordinator_parser.add_argument("-o", "--output", help="write results to this JSON file (default stdout)")
+
+    worker_parser = subparsers.add_parser("worker", help="run jobs from a coordinator")
+    worker_parser.add_argument("coordinator", help="coordinator address as HOST:PORT")
+    worker_parser.add_argument("--worker-id", help="unique worker name (default HOSTNAME-PID)")
+    worker_parser.add_argument("--cached-dbs", help="comma-separated DBs held in this node's local caches")
+    worker_parser.add_argument("--runner", help="job runner as module:function (default run_job)")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    if args.command == "coordinator":
+        with open(args.jobs) as f:
+            jobs = json.load(f)
+        coordinator = Coordinator(
+            jobs, host=args.host, port=args.port,
+            heartbeat_timeout=args.heartbeat_timeout, max_retries=args.max_retries,
+            token=os.environ.get("BACKTEST_FARM_TOKEN")).start()
+        results = coordinator.wait()
+        # give workers a moment to receive their shutdown message
+        time.sleep(1)
+        coordinator.stop()
+
+        output = json.dumps(list(results.values()), indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output)
+        else:
+            print(output)
+
+    else:
+        host, port = args.coordinator.rsplit(":", 1)
+        Worker(
+            (host, int(port)),
+            worker_id=args.worker_id,
+            cached_dbs=args.cached_dbs.split(",") if args.cached_dbs else None,
+            runner=_load_runner(args.runner) if args.runner else run_job,
+            token=os.environ.get("BACKTEST_FARM_TOKEN")).run()
+
+if __name__ == "__main__":
+    main()
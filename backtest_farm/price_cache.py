@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Shared-memory price cache for concurrent backtests on one host.
+
+When dma-tech, umd-demo and a notebook run at the same time, each process
+calls get_historical_prices and holds its own copy of the same prices. The
+cache daemon instead loads each distinct query (DB, fields, times, date
+range, ...) once into POSIX shared memory, and clients map it into their
+own address space as a read-only DataFrame without copying it.
+
+Each dataset is stored as one float64 (rows x ConIds) segment plus a small
+segment holding the pickled index and columns. The daemon counts how many
+client connections have each dataset attached; when the total size exceeds
+the memory budget, datasets that no client holds are evicted, least
+recently used first. A client's references are released when it calls
+release() or disconnects.
+
+Only history DB fields are served (no master fields), so that every
+dataset is a single numeric block.
+
+Clients talk to the daemon over a Unix socket using the same
+newline-delimited JSON messages as job_queue.py:
+
+    client -> daemon   {"type": "attach", "query": {...}}
+    daemon -> client   {"type": "attached", "key": ..., "name": ..., "shape": [...], ...}
+    client -> daemon   {"type": "release", "key": ...}
+    daemon -> client   {"type": "released", "key": ...}
+    client -> daemon   {"type": "stats"}
+    daemon -> client   {"type": "stats", ...}
+    daemon -> client   {"type": "error", "error": ...}
+
+A failed load or unknown message type gets an error reply. A malformed
+message gets an error reply and the connection is closed, which releases
+its datasets.
+
+Start the daemon:
+
+    python price_cache.py serve --socket /tmp/price_cache.sock --memory-budget 8G
+
+Use it from any process on the box:
+
+    client = PriceCacheClient("/tmp/price_cache.sock")
+    prices = client.get_prices("demo-stocks-1d", start_date="2010-01-01", fields=["Close", "Volume"])
+    closes = prices.loc["Close"]
+    ...
+    client.close()
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import os
+import pickle
+import socket
+import socketserver
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("backtest_farm.price_cache")
+
+DEFAULT_SOCKET_PATH = "/tmp/price_cache.sock"
+
+# get_historical_prices parameters that may be part of a query
+QUERY_PARAMS = (
+    "codes", "start_date", "end_date", "universes", "conids", "exclude_universes",
+    "exclude_conids", "times", "cont_fut", "fields", "timezone")
+
+class ProtocolError(Exception):
+    pass
+
+def send_message(wfile, message):
+    wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+    wfile.flush()
+
+def read_message(rfile):
+    """
+    Reads one message, returning None if the connection was closed.
+    """
+    line = rfile.readline()
+    if not line:
+        return None
+    return json.loads(line.decode("utf-8"))
+
+def normalize_query(**query):
+    """
+    Returns a query dict with unknown parameters rejected, None values
+    dropped and lists sorted, so that equivalent queries share a key.
+    """
+    unknown = set(query) - set(QUERY_PARAMS)
+    if unknown:
+        raise ValueError("unsupported query parameters: {0}".format(", ".join(sorted(unknown))))
+
+    normalized = {}
+    for param, value in query.items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            value = sorted(value)
+        elif param in ("codes", "universes", "conids", "exclude_universes",
+                       "exclude_conids", "times", "fields"):
+            value = [value]
+        normalized[param] = value
+    return normalized
+
+def query_key(query):
+    return hashlib.sha1(json.dumps(query, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def parse_size(size):
+    """
+    Parses a size such as 512M or 8G into bytes.
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    size = str(size).strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def _load_prices(**query):
+    from quantrocket.history import get_historical_prices
+    return get_historical_prices(**query)
+
+def _attach(name):
+    """
+    Attaches to an existing shared memory segment without registering it
+    with this process's resource tracker, which would otherwise unlink the
+    daemon's segment when this process exits.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+class _Dataset(object):
+
+    def __init__(self, key, prices):
+        values = prices.to_numpy(dtype=np.float64)
+        meta = pickle.dumps((prices.index, prices.columns), protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.key = key
+        self.shape = values.shape
+        self.shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=np.float64, buffer=self.shm.buf)[:] = values
+        self.meta_shm = shared_memory.SharedMemory(create=True, size=len(meta))
+        self.meta_shm.buf[:len(meta)] = meta
+        self.meta_size = len(meta)
+        self.refs = 0
+        self.last_used = time.time()
+
+    @property
+    def nbytes(self):
+        return self.shm.size + self.meta_shm.size
+
+    def unlink(self):
+        for shm in (self.shm, self.meta_shm):
+            shm.close()
+            shm.unlink()
+
+class PriceCacheDaemon(object):
+    """
+    Serves shared-memory price datasets over a Unix socket.
+
+    Parameters
+    ----------
+    socket_path : str
+        path of the Unix socket to listen on
+
+    memory_budget : int
+        bytes of shared memory to keep before evicting unreferenced
+        datasets (default 4 GiB)
+
+    loader : callable, optional
+        function called with a query's get_historical_prices keyword
+        arguments, returning a DataFrame of prices (default
+        quantrocket.history.get_historical_prices)
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, memory_budget=4*1024**3, loader=None):
+        self.socket_path = socket_path
+        self.memory_budget = memory_budget
+        self.loader = loader or _load_prices
+
+        self._lock = threading.Lock()
+        self._datasets = collections.OrderedDict()
+        self._loading = {}
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                daemon._serve_client(self.rfile, self.wfile)
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self._server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        self._server.daemon_threads = True
+
+    @property
+    def used_bytes(self):
+        return sum(dataset.nbytes for dataset in self._datasets.values())
+
+    def serve_forever(self):
+        try:
+            self._server.serve_forever()
+        finally:
+            self.close()
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def close(self):
+        """
+        Stops serving and unlinks all shared memory.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        with self._lock:
+            for dataset in self._datasets.values():
+                dataset.unlink()
+            self._datasets.clear()
+
+    def _acquire(self, query):
+        """
+        Returns the dataset for query with its reference count incremented,
+        loading it if needed. Concurrent requests for the same query wait
+        for a single load.
+        """
+        key = query_key(query)
+        while True:
+            with self._lock:
+                dataset = self._datasets.get(key)
+                if dataset is not None:
+                    dataset.refs += 1
+                    dataset.last_used = time.time()
+                    self._datasets.move_to_end(key)
+                    return dataset
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    break
+            loading.wait()
+
+        try:
+            logger.info("loading %s: %s", key, query)
+            dataset = _Dataset(key, self.loader(**query))
+            with self._lock:
+                dataset.refs += 1
+                self._datasets[key] = dataset
+                self._evict()
+            return dataset
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def _release(self, key):
+        with self._lock:
+            dataset = self._datasets.get(key)
+            if dataset is not None:
+                dataset.refs -= 1
+                dataset.last_used = time.time()
+                self._evict()
+
+    def _evict(self):
+        """
+        Evicts unreferenced datasets, least recently used first, until
+        usage is within the budget. Call with the lock held.
+        """
+        used = self.used_bytes
+        if used <= self.memory_budget:
+            return
+        for dataset in sorted(self._datasets.values(), key=lambda dataset: dataset.last_used):
+            if used <= self.memory_budget:
+                break
+            if dataset.refs > 0:
+                continue
+            logger.info("evicting %s (%d bytes)", dataset.key, dataset.nbytes)
+            del self._datasets[dataset.key]
+            dataset.unlink()
+            used -= dataset.nbytes
+        if used > self.memory_budget:
+            logger.warning("%d bytes in use by attached datasets, over the %d byte budget",
+                           used, self.memory_budget)
+
+    def _stats(self):
+        with self._lock:
+            return {
+                "type": "stats",
+                "memory_budget": self.memory_budget,
+                "used_bytes": self.used_bytes,
+                "datasets": [
+                    {"key": dataset.key, "refs": dataset.refs, "bytes": dataset.nbytes,
+                     "shape": dataset.shape}
+                    for dataset in self._datasets.values()]}
+
+    def _serve_client(self, rfile, wfile):
+        # references held by this connection
+        refs = collections.Counter()
+        try:
+            while True:
+                message = read_message(rfile)
+                if message is None:
+                    break
+                if not isinstance(message, dict):
+                    raise ProtocolError("message is not a JSON object")
+
+                message_type = message.get("type")
+
+                if message_type == "attach":
+                    query = message.get("query")
+                    if not isinstance(query, dict):
+                        raise ProtocolError("attach is missing query")
+                    try:
+                        dataset = self._acquire(normalize_query(**query))
+                    except Exception as e:
+                        logger.exception("failed to load %s", query)
+                        send_message(wfile, {"type": "error", "error": repr(e)})
+                        continue
+                    refs[dataset.key] += 1
+                    send_message(wfile, {
+                        "type": "attached",
+                        "key": dataset.key,
+                        "name": dataset.shm.name,
+                        "shape": dataset.shape,
+                        "meta_name": dataset.meta_shm.name,
+                        "meta_size": dataset.meta_size})
+
+                elif message_type == "release":
+                    key = message.get("key")
+                    if not isinstance(key, str):
+                        raise ProtocolError("release is missing key")
+                    if refs[key] > 0:
+                        refs[key] -= 1
+                        self._release(key)
+                    send_message(wfile, {"type": "released", "key": key})
+
+                elif message_type == "stats":
+                    send_message(wfile, self._stats())
+
+                else:
+                    send_message(wfile, {
+                        "type": "error", "error": "unknown message type: {0}".format(message_type)})
+
+        except ProtocolError as e:
+            logger.warning("closing connection to client: %s", e)
+            try:
+                send_message(wfile, {"type": "error", "error": str(e)})
+            except OSError:
+                pass
+        except (OSError, ValueError) as e:
+            logger.warning("lost connection to client: %s", e)
+        except Exception:
+            logger.exception("error serving client")
+        finally:
+            for key, count in refs.items():
+                for _ in range(count):
+                    self._release(key)
+
+class PriceCacheClient(object):
+    """
+    Client for a PriceCacheDaemon.
+
+    DataFrames returned by get_prices are read-only views of the daemon's
+    shared memory and remain valid until released.
+
+    Parameters
+    ----------
+    socket_path : str
+        path of the daemon's Unix socket
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(socket_path)
+        self._rfile = self._sock.makefile("rb")
+        self._wfile = self._sock.makefile("wb")
+        self._lock = threading.Lock()
+        # key -> list of (shm, prices) for each attach
+        self._attached = collections.defaultdict(list)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, message):
+        with self._lock:
+            send_message(self._wfile, message)
+            reply = read_message(self._rfile)
+        if reply is None:
+            raise ConnectionError("price cache daemon closed the connection")
+        if reply["type"] == "error":
+            raise RuntimeError("price cache daemon error: {0}".format(reply["error"]))
+        return reply
+
+    def get_prices(self, codes, start_date=None, end_date=None, **query):
+        """
+        Returns prices for a query as a read-only DataFrame backed by shared
+        memory, loading them in the daemon if no other client has.
+
+        Accepts the same parameters as
+        quantrocket.history.get_historical_prices, except master_fields
+        and infer_timezone.
+        """
+        query = normalize_query(codes=codes, start_date=start_date, end_date=end_date, **query)
+        reply = self._request({"type": "attach", "query": query})
+
+        meta_shm = _attach(reply["meta_name"])
+        try:
+            index, columns = pickle.loads(bytes(meta_shm.buf[:reply["meta_size"]]))
+        finally:
+            meta_shm.close()
+
+        shm = _attach(reply["name"])
+        values = np.ndarray(tuple(reply["shape"]), dtype=np.float64, buffer=shm.buf)
+        values.flags.writeable = False
+        prices = pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+        self._attached[reply["key"]].append(shm)
+        prices.attrs["price_cache_key"] = reply["key"]
+        return prices
+
+    def release(self, prices):
+        """
+        Releases a DataFrame returned by get_prices. The DataFrame and any
+        views of it must not be used afterwards.
+        """
+        key = prices.attrs["price_cache_key"]
+        shms = self._attached.get(key)
+        if not shms:
+            return
+        shm = shms.pop()
+        if not shms:
+            del self._attached[key]
+        self._request({"type": "release", "key": key})
+        try:
+            shm.close()
+        except BufferError:
+            # views of the segment are still alive; the mapping is removed
+            # once they are garbage collected
+            pass
+
+    def stats(self):
+        """
+        Returns the daemon's memory usage and datasets.
+        """
+        return self._request({"type": "stats"})
+
+    def close(self):
+        """
+        Closes the connection, which releases all attached datasets.
+        """
+        self._rfile.close()
+        self._wfile.close()
+        self._sock.close()
+        for shms in self._attached.values():
+            for shm in shms:
+                try:
+                    shm.close()
+                except BufferError:
+                    pass
+        self._attached.clear()
+
+def main():
+    parser = argparse.ArgumentParser(description="shared-memory price cache")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    serve_parser = subparsers.add_parser("serve", help="run the cache daemon")
+    serve_parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH,
+                              help="Unix socket path (default {0})".format(DEFAULT_SOCKET_PATH))
+    serve_parser.add_argument("--memory-budget", default="4G",
+                              help="shared memory to use before evicting unused datasets (default 4G)")
+
+    stats_parser = subparsers.add_parser("stats", help="show the daemon's datasets and memory usage")
+    stats_parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH,
+                              help="Unix socket path (default {0})".format(DEFAULT_SOCKET_PATH))
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    if args.command == "serve":
+        daemon = PriceCacheDaemon(args.socket, memory_budget=parse_size(args.memory_budget))
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        with PriceCacheClient(args.socket) as client:
+            print(json.dumps(client.stats(), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Warm worker pool for countdown crontabs.
+
+Runs the commands in a countdown crontab (for example
+quantrocket.countdown-australia.crontab) on a pool of long-lived worker
+processes instead of starting a fresh process for every line. Each worker
+imports pandas, moonshot, zipline and the quantrocket client once, at
+startup, and `quantrocket ...` commands are then executed in-process by
+calling the quantrocket CLI entry point directly.
+
+Jobs that fire in the same minute are dispatched together as one batch, and
+identical commands scheduled for the same minute are only run once. After
+each job, the queue latency (time from the scheduled minute until a worker
+picked the job up) and the run latency are logged. Minutes missed because
+the scheduler overslept or the clock stepped forward are caught up, but only
+for the last max_catch_up minutes; jobs due earlier than that are logged as
+skipped instead of firing late.
+
+Usage:
+
+    python warm_pool.py quantrocket.countdown-australia.crontab --workers 4 --timezone Australia/Sydney
+"""
+
+import argparse
+import datetime
+import importlib
+import logging
+import multiprocessing
+import os
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    from dateutil.tz import gettz as ZoneInfo
+
+# modules each worker imports once at startup
+PREIMPORT_MODULES = [
+    "pandas",
+    "moonshot",
+    "zipline",
+    "quantrocket",
+]
+
+MONTH_NAMES = {
+    name: i + 1 for i, name in enumerate(
+        ["jan", "feb", "mar", "apr", "may", "jun",
+         "jul", "aug", "sep", "oct", "nov", "dec"])
+}
+
+DAY_NAMES = {
+    name: i for i, name in enumerate(
+        ["sun", "mon", "tue", "wed", "thu", "fri", "sat"])
+}
+
+logger = logging.getLogger("countdown.warm_pool")
+
+def _parse_cron_field(field, minval, maxval, names=None):
+    """
+    Parses a single cron field (e.g. "*/15", "1-5", "mon-fri", "0,30") into
+    the set of matching integers.
+    """
+    values = set()
+    for part in field.lower().split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+
+        if part == "*":
+            start, end = minval, maxval
+        elif "-" in part:
+            start, end = part.split("-", 1)
+            start = names[start] if names and start in names else int(start)
+            end = names[end] if names and end in names else int(end)
+        else:
+            start = names[part] if names and part in names else int(part)
+            # a single value with a step (e.g. 5/15) runs through the max
+            end = maxval if step > 1 else start
+
+        if start < minval or end > maxval or start > end:
+            raise ValueError("invalid cron field: {0}".format(field))
+
+        values.update(range(start, end + 1, step))
+
+    return values
+
+class CronJob(object):
+    """
+    A single crontab line: a cron schedule expression and a command.
+    """
+
+    def __init__(self, schedule, command, lineno=None):
+        self.schedule = schedule
+        self.command = command
+        self.lineno = lineno
+
+        minute, hour, dom, month, dow = schedule.split()
+        # like cron, a field starting with * (including */2) counts as
+        # unrestricted when combining day of month and day of week
+        self.dom_restricted = not dom.startswith("*")
+        self.dow_restricted = not dow.startswith("*")
+        self.minutes = _parse_cron_field(minute, 0, 59)
+        self.hours = _parse_cron_field(hour, 0, 23)
+        self.doms = _parse_cron_field(dom, 1, 31)
+        self.months = _parse_cron_field(month, 1, 12, MONTH_NAMES)
+        # 7 is an alias for Sunday
+        self.dows = {d % 7 for d in _parse_cron_field(dow, 0, 7, DAY_NAMES)}
+
+    def __repr__(self):
+        return "<CronJob line {0}: {1} {2}>".format(self.lineno, self.schedule, self.command)
+
+    def matches(self, dt):
+        """
+        Returns True if the job is scheduled to run in the minute of dt.
+        """
+        if dt.minute not in self.minutes or dt.hour not in self.hours:
+            return False
+        if dt.month not in self.months:
+            return False
+
+        dom_match = dt.day in self.doms
+        # datetime weekday() is Monday=0, cron is Sunday=0
+        dow_match = (dt.weekday() + 1) % 7 in self.dows
+
+        # Standard cron semantics: if both day of month and day of week are
+        # restricted, the job runs when either one matches
+        if self.dom_restricted and self.dow_restricted:
+            return dom_match or dow_match
+        return dom_match and dow_match
+
+def parse_crontab(path):
+    """
+    Parses a crontab file into a list of CronJobs, skipping comments and
+    blank lines.
+    """
+    jobs = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split(None, 5)
+            if len(parts) < 6:
+                raise ValueError("line {0} of {1} is not a valid crontab entry: {2}".format(
+                    lineno, path, line))
+            schedule = " ".join(parts[:5])
+            command = parts[5]
+            jobs.append(CronJob(schedule, command, lineno=lineno))
+    return jobs
+
+# Set in each worker by _init_worker
+_quantrocket_main = None
+_ready_barrier = None
+
+def _init_worker(modules, ready_barrier=None):
+    """
+    Worker initializer: pays the import cost once per worker.
+    """
+    global _quantrocket_main, _ready_barrier
+
+    _ready_barrier = ready_barrier
+
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+    try:
+        from importlib.metadata import entry_points
+        scripts = entry_points(group="console_scripts", name="quantrocket")
+        for script in scripts:
+            _quantrocket_main = script.load()
+            break
+    except Exception:
+        _quantrocket_main = None
+
+def _wait_until_ready(timeout):
+    """
+    Blocks until every worker is running (and so has finished its
+    initializer), and returns this worker's pid.
+    """
+    _ready_barrier.wait(timeout)
+    return os.getpid()
+
+def _run_command(command, scheduled_at):
+    """
+    Runs a crontab command in the worker and returns a dict of timings.
+    """
+    started_at = time.time()
+    argv = shlex.split(command)
+
+    if argv and argv[0] == "quantrocket" and _quantrocket_main is not None:
+        # run the quantrocket CLI in-process, as the console script would
+        orig_argv = sys.argv
+        sys.argv = argv
+        try:
+            _quantrocket_main()
+            returncode = 0
+        except SystemExit as e:
+            if e.code is None:
+                returncode = 0
+            elif isinstance(e.code, int):
+                returncode = e.code
+            else:
+                returncode = 1
+        except Exception:
+            logger.exception("command failed: %s", command)
+            returncode = 1
+        finally:
+            sys.argv = orig_argv
+    else:
+        # anything else still runs in a subprocess
+        returncode = subprocess.run(command, shell=True).returncode
+
+    finished_at = time.time()
+
+    return {
+        "command": command,
+        "returncode": returncode,
+        "queue_latency": started_at - scheduled_at,
+        "run_latency": finished_at - started_at,
+    }
+
+class WarmPoolScheduler(object):
+    """
+    Dispatches due crontab jobs to a pool of pre-imported worker processes.
+
+    Parameters
+    ----------
+    jobs : list of CronJob
+        the parsed crontab
+
+    workers : int
+        number of worker processes
+
+    timezone : str, optional
+        timezone in which to evaluate the cron schedules (default is the
+        local timezone)
+
+    preimport_modules : list of str, optional
+        modules each worker imports at startup (default PREIMPORT_MODULES)
+
+    max_catch_up : int
+        most minutes to catch up on after an oversleep or a forward clock
+        step; jobs due before that are skipped (default 5)
+    """
+
+    def __init__(self, jobs, workers=4, timezone=None, preimport_modules=None,
+                 max_catch_up=5):
+        self.jobs = jobs
+        self.workers = workers
+        self.timezone = ZoneInfo(timezone) if timezone else None
+        self.preimport_modules = preimport_modules or PREIMPORT_MODULES
+        self.max_catch_up = max_catch_up
+        self.pool = None
+
+    def start(self, timeout=300):
+        ready_barrier = multiprocessing.Barrier(self.workers)
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(self.preimport_modules, ready_barrier))
+
+        # Make sure every worker has finished its imports before the first
+        # jobs are due: each task blocks until all workers hold one, which
+        # forces the pool to start every worker, and a task only runs after
+        # its worker's initializer has returned
+        pids = set(self.pool.map(_wait_until_ready, [timeout] * self.workers))
+        logger.info("%d workers ready", len(pids))
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    def due_commands(self, dt):
+        """
+        Returns the commands due in the minute of dt, coalescing duplicates
+        and preserving crontab order.
+        """
+        commands = []
+        for job in self.jobs:
+            if job.matches(dt) and job.command not in commands:
+                commands.append(job.command)
+        return commands
+
+    def dispatch(self, dt):
+        """
+        Submits all commands due in the minute of dt to the pool as one batch
+        and returns the futures.
+        """
+        scheduled_at = dt.replace(second=0, microsecond=0).timestamp()
+        return [
+            self.pool.submit(_run_command, command, scheduled_at)
+            for command in self.due_commands(dt)]
+
+    def _log_result(self, future):
+        try:
+            result = future.result()
+        except Exception:
+            logger.exception("job failed")
+            return
+        logger.info(
+            "%s returncode=%s queue_latency=%.3fs run_latency=%.3fs",
+            result["command"], result["returncode"],
+            result["queue_latency"], result["run_latency"])
+
+    def minutes_to_dispatch(self, last_dispatched, now):
+        """
+        Returns the minutes after last_dispatched up to and including the
+        minute of now, in the scheduler's timezone. Minutes are stepped in
+        UTC so that DST changes don't skip or repeat any. If the clock
+        stepped back, nothing is returned, so no minute runs twice. Only the
+        last max_catch_up missed minutes are returned before the minute of
+        now; jobs due in earlier missed minutes are logged as skipped.
+        """
+        minute = now.astimezone(datetime.timezone.utc).replace(second=0, microsecond=0)
+        if last_dispatched is None:
+            return [minute.astimezone(self.timezone)]
+
+        minutes = []
+        next_minute = last_dispatched.astimezone(datetime.timezone.utc) + datetime.timedelta(minutes=1)
+        while next_minute <= minute:
+            minutes.append(next_minute.astimezone(self.timezone))
+            next_minute += datetime.timedelta(minutes=1)
+
+        skipped = minutes[:max(0, len(minutes) - 1 - self.max_catch_up)]
+        if skipped:
+            logger.warning("skipping %d missed minutes from %s to %s",
+                           len(skipped), skipped[0].isoformat(), skipped[-1].isoformat())
+            for skipped_minute in skipped:
+                for command in self.due_commands(skipped_minute):
+                    logger.warning("skipped %s due at %s", command, skipped_minute.isoformat())
+        return minutes[len(skipped):]
+
+    def run_forever(self):
+        self.start()
+        last_dispatched = None
+        try:
+            while True:
+                now = datetime.datetime.now(self.timezone)
+                minutes = self.minutes_to_dispatch(last_dispatched, now)
+                if len(minutes) > 1:
+                    logger.warning(
+                        "catching up on %d minutes after a clock step or oversleep", len(minutes) - 1)
+                for minute in minutes:
+                    for future in self.dispatch(minute):
+                        future.add_done_callback(self._log_result)
+                    last_dispatched = minute
+
+                # sleep until the start of the next minute
+                next_minute = now.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+                time.sleep(max(0, (next_minute - datetime.datetime.now(self.timezone)).total_seconds()))
+        finally:
+            self.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="run a countdown crontab on a warm worker pool")
+    parser.add_argument("crontab", help="path to the crontab file")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="number of worker processes (default 4)")
+    parser.add_argument("-t", "--timezone", help="timezone for evaluating cron schedules (default local time)")
+    parser.add_argument("--max-catch-up", type=int, default=5,
+                        help="most missed minutes to catch up on after an oversleep or clock step (default 5)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    scheduler = WarmPoolScheduler(
+        parse_crontab(args.crontab),
+        workers=args.workers,
+        timezone=args.timezone,
+        max_catch_up=args.max_catch_up)
+    scheduler.run_forever()
+
+if __name__ == "__main__":
+    main()
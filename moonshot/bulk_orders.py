@@ -0,0 +1,157 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Columnar order construction for order_stubs_to_orders.
+
+The usual pattern of setting columns on the order stubs DataFrame, building
+child orders with orders_to_child_orders and then pd.concat-ing parents and
+children creates several intermediate DataFrames per strategy per account.
+BulkOrderBuilder instead preallocates one NumPy array per column, sized for
+the parent orders plus (optionally) one child order per parent, sets fields
+in bulk on row slices, and links children to parents with an index array.
+A DataFrame is only built once, by to_frame(), when the orders are handed
+back to Moonshot.
+
+The output matches orders_to_child_orders: parents get a unique OrderId
+made from the order stubs index plus a timestamp (or keep an existing
+OrderId column), and children are identical to their parents except that
+the Action is reversed and they carry the parent's OrderId as ParentId.
+
+Usage, in order_stubs_to_orders:
+
+    builder = BulkOrderBuilder(orders, child_orders=True)
+    builder.set("Exchange", "SMART")
+    builder.set("Tif", "Day")
+    builder.set("OrderType", "MKT", rows=builder.parents)
+    builder.set("OrderType", "MOC", rows=builder.children)
+    return builder.to_frame()
+"""
+
+import time
+import numpy as np
+import pandas as pd
+
+# order fields commonly set in order_stubs_to_orders
+ORDER_FIELDS = ["Exchange", "OrderType", "Tif"]
+
+REVERSED_ACTIONS = {"BUY": "SELL", "SELL": "BUY"}
+
+def make_order_ids(index):
+    """
+    Returns OrderIds for an order stubs index that are unique across runs,
+    strategies and accounts, in the same format as orders_to_child_orders.
+    """
+    suffix = ".{0}".format(time.time())
+    order_ids = np.empty(len(index), dtype=object)
+    order_ids[:] = [str(i) + suffix for i in index]
+    return order_ids
+
+class BulkOrderBuilder(object):
+    """
+    Preallocated columnar store of parent and child orders.
+
+    Parameters
+    ----------
+    order_stubs : DataFrame
+        the order stubs passed to order_stubs_to_orders
+
+    child_orders : bool
+        if True, allocate one child order per parent order, linked via
+        OrderId/ParentId as with orders_to_child_orders (default False)
+
+    fields : list of str
+        additional order fields to preallocate (default ORDER_FIELDS)
+    """
+
+    def __init__(self, order_stubs, child_orders=False, fields=ORDER_FIELDS):
+        num_parents = len(order_stubs)
+        size = num_parents * 2 if child_orders else num_parents
+
+        self.parents = slice(0, num_parents)
+        self.children = slice(num_parents, size) if child_orders else None
+
+        # for each child row, the row of its parent
+        self.parent_rows = np.arange(num_parents) if child_orders else None
+
+        stub_index = order_stubs.index.to_numpy()
+        self.index = np.empty(size, dtype=stub_index.dtype)
+        self.index[self.parents] = stub_index
+
+        self.columns = {}
+        for column in order_stubs.columns:
+            values = order_stubs[column].to_numpy()
+            self.columns[column] = np.empty(size, dtype=values.dtype)
+            self.columns[column][self.parents] = values
+
+        for field in fields:
+            if field not in self.columns:
+                self.columns[field] = np.full(size, None, dtype=object)
+
+        if child_orders:
+            self.index[self.children] = stub_index[self.parent_rows]
+            for column, values in self.columns.items():
+                if column in order_stubs.columns:
+                    values[self.children] = values[self.parent_rows]
+
+            if "Action" in self.columns:
+                # slicing returns a view, so this updates the column in place
+                child_actions = self.columns["Action"][self.children]
+                parent_actions = child_actions.copy()
+                for action, reversed_action in REVERSED_ACTIONS.items():
+                    child_actions[parent_actions == action] = reversed_action
+
+            if "OrderId" in order_stubs.columns:
+                stub_order_ids = order_stubs["OrderId"].to_numpy()
+            else:
+                stub_order_ids = make_order_ids(stub_index)
+
+            order_ids = np.full(size, np.nan, dtype=object)
+            order_ids[self.parents] = stub_order_ids
+            parent_ids = np.full(size, np.nan, dtype=object)
+            parent_ids[self.children] = stub_order_ids[self.parent_rows]
+
+            self.columns["OrderId"] = order_ids
+            self.columns["ParentId"] = parent_ids
+
+    def __len__(self):
+        return len(self.index)
+
+    def set(self, field, value, rows=None):
+        """
+        Sets a field in bulk.
+
+        Parameters
+        ----------
+        field : str
+            the order field (e.g. "OrderType")
+
+        value : scalar or array-like
+            the value(s) to set
+
+        rows : slice or array of int or bool, optional
+            the rows to set, e.g. builder.parents or builder.children
+            (default all rows)
+        """
+        if field not in self.columns:
+            self.columns[field] = np.full(len(self), None, dtype=object)
+        if rows is None:
+            rows = slice(None)
+        self.columns[field][rows] = value
+
+    def to_frame(self):
+        """
+        Returns the orders as a DataFrame, parents first, then children.
+        """
+        return pd.DataFrame(self.columns, index=self.index)
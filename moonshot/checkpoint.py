@@ -0,0 +1,295 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Append-only Moonshot backtests with checkpoints.
+
+Re-running DualMovingAverageStrategy, UpMinusDown or HighMinusLow over the
+full history every night only adds one new day to the performance record.
+CheckpointedBacktest stores the results of the first (full) run together
+with a checkpoint of the strategy's state on the last date: the last
+signals, weights and positions and the cumulative return. Subsequent runs
+only backtest from a few bars before the checkpoint, so Moonshot loads just
+the new bars plus the strategy's LOOKBACK_WINDOW of warm-up, and the new
+rows are appended to the stored results.
+
+Before each incremental run the stored results are checked against the
+checkpoint, so results left out of step with it (for example by a crash
+between the two writes) are not built upon. The new run must reproduce the
+checkpointed state on the checkpoint date, and every stored field
+(Signal, Weight, Turnover, Commission, ...) on the overlapping bars is
+compared with the stored results before anything is appended. Every
+full_rerun_every runs the whole history is backtested again and compared
+with the accumulated record. Any mismatch (for example from a data
+revision) replaces the stored results with a full rerun.
+
+Usage:
+
+    backtest = CheckpointedBacktest(UpMinusDownDemo, "/codeload/checkpoints")
+    results = backtest.run(start_date="2005-01-01")
+"""
+
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("moonshot.checkpoint")
+
+# Fields whose last row is stored in the checkpoint (all fields are compared
+# on the overlapping bars)
+STATE_FIELDS = ["Signal", "Weight", "NetExposure", "Return"]
+
+class CheckpointMismatch(Exception):
+    pass
+
+class CheckpointedBacktest(object):
+    """
+    Backtest a Moonshot strategy incrementally, appending new bars to
+    stored results.
+
+    Parameters
+    ----------
+    strategy_cls : type
+        the Moonshot strategy class
+
+    checkpoint_dir : str
+        directory for the stored results and checkpoint
+
+    overlap : int
+        number of already-stored bars to re-run and compare on each
+        incremental run (default 5)
+
+    full_rerun_every : int
+        re-run the full history for a consistency check every this many
+        incremental runs (default 20; 0 to disable)
+
+    tolerance : float
+        absolute tolerance when comparing results (default 1e-9)
+    """
+
+    def __init__(self, strategy_cls, checkpoint_dir, overlap=5, full_rerun_every=20,
+                 tolerance=1e-9):
+        self.strategy_cls = strategy_cls
+        self.checkpoint_dir = checkpoint_dir
+        self.overlap = overlap
+        self.full_rerun_every = full_rerun_every
+        self.tolerance = tolerance
+
+    @property
+    def results_path(self):
+        return os.path.join(self.checkpoint_dir, "{0}.results.pkl".format(self.strategy_cls.CODE))
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(self.checkpoint_dir, "{0}.checkpoint.json".format(self.strategy_cls.CODE))
+
+    def load(self):
+        """
+        Returns the stored results and checkpoint, or (None, None).
+        """
+        if not os.path.exists(self.results_path) or not os.path.exists(self.checkpoint_path):
+            return None, None
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        return pd.read_pickle(self.results_path), checkpoint
+
+    def _state(self, results, date):
+        """
+        Returns the STATE_FIELDS rows of results on date, as a dict of
+        {field: {column: value}}.
+        """
+        state = {}
+        for field in STATE_FIELDS:
+            if field in results.index.get_level_values("Field"):
+                field_rows = results.loc[field]
+                rows = field_rows[field_rows.index.get_level_values("Date") == date]
+                if rows.empty:
+                    continue
+                state[field] = {
+                    str(k): (None if pd.isnull(v) else float(v)) for k, v in rows.iloc[-1].items()}
+        return state
+
+    def _cumulative_return(self, results, date):
+        returns = results.loc["Return"].sum(axis=1)
+        returns = returns[returns.index.get_level_values("Date") <= date]
+        return float((1 + returns).prod() - 1)
+
+    def _save(self, results, start_date, runs_since_full_rerun):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+        last_date = self._dates(results)[-1]
+        checkpoint = {
+            "code": self.strategy_cls.CODE,
+            "start_date": start_date,
+            "last_date": str(pd.Timestamp(last_date).date()),
+            "runs_since_full_rerun": runs_since_full_rerun,
+            "cumulative_return": self._cumulative_return(results, last_date),
+            "state": self._state(results, last_date),
+        }
+
+        # write the results before the checkpoint, so a crash in between
+        # leaves the previous checkpoint pointing at complete results
+        results.to_pickle(self.results_path + ".tmp")
+        os.replace(self.results_path + ".tmp", self.results_path)
+        with open(self.checkpoint_path + ".tmp", "w") as f:
+            json.dump(checkpoint, f, indent=2)
+        os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+        return checkpoint
+
+    def _dates(self, results):
+        return results.index.get_level_values("Date").unique().sort_values()
+
+    def _backtest(self, start_date, end_date, **kwargs):
+        strategy = self.strategy_cls()
+        return strategy.backtest(start_date=start_date, end_date=end_date, **kwargs)
+
+    def _compare(self, stored, new, dates):
+        """
+        Raises CheckpointMismatch if any field of the stored results differs
+        from the new results on dates.
+        """
+        new_fields = new.index.get_level_values("Field")
+        for field in stored.index.get_level_values("Field").unique():
+            if field not in new_fields:
+                raise CheckpointMismatch(
+                    "{0} is missing from new results for {1}".format(field, self.strategy_cls.CODE))
+            stored_field = stored.loc[field]
+            new_field = new.loc[field].reindex(columns=stored_field.columns)
+            stored_rows = stored_field[stored_field.index.get_level_values("Date").isin(dates)]
+            new_rows = new_field[new_field.index.get_level_values("Date").isin(dates)]
+            if stored_rows.shape != new_rows.shape or not np.allclose(
+                    stored_rows.values.astype(float), new_rows.values.astype(float),
+                    atol=self.tolerance, equal_nan=True):
+                raise CheckpointMismatch(
+                    "{0} differs from stored results for {1} between {2} and {3}".format(
+                        field, self.strategy_cls.CODE, dates[0].date(), dates[-1].date()))
+
+    def _check_state(self, results, checkpoint):
+        """
+        Raises CheckpointMismatch if results don't reproduce the checkpointed
+        state on the checkpoint date.
+        """
+        last_date = pd.Timestamp(checkpoint["last_date"])
+        state = self._state(results, last_date)
+        for field, expected in checkpoint["state"].items():
+            actual = state.get(field, {})
+            columns = sorted(expected)
+            if sorted(actual) != columns or not np.allclose(
+                    np.array([actual[c] for c in columns], dtype=float),
+                    np.array([expected[c] for c in columns], dtype=float),
+                    atol=self.tolerance, equal_nan=True):
+                raise CheckpointMismatch(
+                    "{0} differs from checkpoint for {1} on {2}".format(
+                        field, self.strategy_cls.CODE, last_date.date()))
+
+    def _check_stored(self, stored, checkpoint):
+        """
+        Raises CheckpointMismatch if the stored results are out of step with
+        the checkpoint.
+        """
+        last_date = pd.Timestamp(checkpoint["last_date"])
+        if self._dates(stored)[-1] != last_date:
+            raise CheckpointMismatch(
+                "stored results for {0} end on {1} but checkpoint is for {2}".format(
+                    self.strategy_cls.CODE, self._dates(stored)[-1].date(), last_date.date()))
+        self._check_state(stored, checkpoint)
+        if not np.isclose(self._cumulative_return(stored, last_date),
+                          checkpoint["cumulative_return"], atol=self.tolerance):
+            raise CheckpointMismatch(
+                "cumulative return of stored results for {0} differs from checkpoint".format(
+                    self.strategy_cls.CODE))
+
+    def _append(self, stored, new, after_date):
+        fields = stored.index.get_level_values("Field").unique()
+        new_rows = new[new.index.get_level_values("Date") > after_date]
+        appended = {}
+        for field in fields:
+            field_rows = stored.loc[field]
+            if field in new_rows.index.get_level_values("Field"):
+                field_rows = pd.concat([field_rows, new_rows.loc[field]])
+            appended[field] = field_rows
+        return pd.concat(appended, names=stored.index.names)
+
+    def run(self, start_date=None, end_date=None, **kwargs):
+        """
+        Runs the backtest, incrementally if a checkpoint exists.
+
+        Parameters
+        ----------
+        start_date : str (YYYY-MM-DD), optional
+            the start date of the full history (only used for full runs)
+
+        end_date : str (YYYY-MM-DD), optional
+            the backtest end date (default is the latest data)
+
+        kwargs :
+            passed to Moonshot.backtest (e.g. nlv, allocation)
+
+        Returns
+        -------
+        DataFrame
+            multiindex (Field, Date) DataFrame of the accumulated results
+        """
+        stored, checkpoint = self.load()
+
+        if stored is None:
+            return self.full_rerun(start_date, end_date, **kwargs)
+
+        start_date = checkpoint["start_date"]
+        runs_since_full_rerun = checkpoint["runs_since_full_rerun"] + 1
+        if self.full_rerun_every and runs_since_full_rerun >= self.full_rerun_every:
+            return self.full_rerun(start_date, end_date, verify_against=stored, **kwargs)
+
+        try:
+            self._check_stored(stored, checkpoint)
+        except CheckpointMismatch as e:
+            logger.warning("%s, running full backtest", e)
+            return self.full_rerun(start_date, end_date, **kwargs)
+
+        # re-run the last `overlap` stored bars, plus any new bars; Moonshot
+        # loads the LOOKBACK_WINDOW warm-up before the start date
+        dates = self._dates(stored)
+        overlap_dates = dates[-self.overlap:]
+        new = self._backtest(str(overlap_dates[0].date()), end_date, **kwargs)
+
+        try:
+            self._check_state(new, checkpoint)
+            self._compare(stored, new, overlap_dates)
+        except CheckpointMismatch as e:
+            logger.warning("%s, running full backtest", e)
+            return self.full_rerun(start_date, end_date, **kwargs)
+
+        results = self._append(stored, new, dates[-1])
+        self._save(results, start_date, runs_since_full_rerun)
+        return results
+
+    def full_rerun(self, start_date=None, end_date=None, verify_against=None, **kwargs):
+        """
+        Backtests the full history and replaces the stored results. If
+        verify_against is given, logs a warning if the accumulated results
+        differ from the full rerun.
+        """
+        results = self._backtest(start_date, end_date, **kwargs)
+
+        if verify_against is not None:
+            try:
+                self._compare(verify_against, results, self._dates(verify_against))
+            except CheckpointMismatch as e:
+                logger.warning("consistency check failed, replacing stored results: %s", e)
+
+        self._save(results, start_date, 0)
+        return results
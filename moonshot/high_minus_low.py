@@ -14,9 +14,9 @@
 
 from moonshot import Moonshot
 from moonshot.commission import PerShareCommission
-from quantrocket.fundamental import get_reuters_financials_reindexed_like
+from codeload.moonshot.prefetch import FundamentalPrefetchMixin
 
-class HighMinusLow(Moonshot):
+class HighMinusLow(FundamentalPrefetchMixin, Moonshot):
     """
     Strategy that buys stocks with high book-to-market ratios and shorts
     stocks with low book-to-market ratios.
@@ -33,6 +33,7 @@ class HighMinusLow(Moonshot):
     CODE = "hml"
     TOP_N_PCT = 10 # Buy/sell the bottom/top decile
     REBALANCE_INTERVAL = "M" # M = monthly; see http://pandas.pydata.org/pandas-docs/stable/timeseries.html#offset-aliases
+    COA_CODES = ["ATOT", "LTLL", "QTCO"] # fetched while prices load (see prefetch.py)
 
     def prices_to_signals(self, prices):
 
@@ -44,7 +45,7 @@ class HighMinusLow(Moonshot):
         # Liabilities), and 'QTCO' (Total Common Shares Outstanding).
 
         closes = prices.loc["Close"]
-        financials = get_reuters_financials_reindexed_like(closes, ["ATOT", "LTLL", "QTCO"])
+        financials = self.get_financials_reindexed_like(closes)
         tot_assets = financials.loc["ATOT"].loc["Amount"]
         tot_liabilities = financials.loc["LTLL"].loc["Amount"]
         shares_out = financials.loc["QTCO"].loc["Amount"]
@@ -0,0 +1,395 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Concurrent loading of prices and fundamentals.
+
+A fundamental strategy like HighMinusLow normally loads prices, and only
+once they have arrived calls get_reuters_financials_reindexed_like, so the
+two round trips to houston happen one after the other. This module lets a
+strategy declare its data up front (DataRequirements) and fetches prices and
+Reuters financials at the same time on a thread pool, optionally split into
+blocks of ConIds, then assembles the blocks into single DataFrames.
+
+All requests go through the quantrocket client, so the loader can be tested
+against a local stand-in service by pointing HOUSTON_URL at it, and the
+assembly in prefetch can be tested with stand-in loaders (see
+tests/test_prefetch.py).
+
+Usage in research:
+
+    requirements = DataRequirements(
+        "amex-1d", fields=["Open", "Close"], coa_codes=["ATOT", "LTLL", "QTCO"],
+        start_date="2010-01-01", conids=conids)
+    data = prefetch(requirements, max_workers=8, block_size=500)
+    closes = data.prices.loc["Close"]
+    financials = reindex_financials_like(data.financials, closes)
+
+Usage in a Moonshot strategy:
+
+    class HighMinusLow(FundamentalPrefetchMixin, Moonshot):
+        COA_CODES = ["ATOT", "LTLL", "QTCO"]
+
+        def prices_to_signals(self, prices):
+            closes = prices.loc["Close"]
+            financials = self.get_financials_reindexed_like(closes)
+"""
+
+import copy
+import io
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+# Financial reports are sparse, so fetch them from well before the first
+# price date (same buffer as get_reuters_financials_reindexed_like)
+FINANCIALS_LOOKBACK = pd.Timedelta(days=365+180)
+
+class DataRequirements(object):
+    """
+    The data a strategy needs, declared up front.
+
+    Parameters
+    ----------
+    db : str or list of str
+        history database code(s)
+
+    fields : list of str, optional
+        price fields to load (default all)
+
+    coa_codes : list of str, optional
+        Reuters financials COA codes to load (e.g. ["ATOT", "LTLL", "QTCO"])
+
+    start_date : str (YYYY-MM-DD), optional
+        start of the date range
+
+    end_date : str (YYYY-MM-DD), optional
+        end of the date range
+
+    conids : list of int, optional
+        ConIds to load. Required to split requests into ConId blocks.
+
+    universes : list of str, optional
+        universes to load, if not loading by ConId
+
+    times : list of str, optional
+        times to load for intraday databases
+
+    interim : bool
+        load interim rather than annual financials (default False)
+    """
+
+    def __init__(self, db, fields=None, coa_codes=None, start_date=None,
+                 end_date=None, conids=None, universes=None, times=None,
+                 interim=False):
+        self.db = db
+        self.fields = fields
+        self.coa_codes = coa_codes
+        self.start_date = start_date
+        self.end_date = end_date
+        self.conids = conids
+        self.universes = universes
+        self.times = times
+        self.interim = interim
+
+    @classmethod
+    def from_strategy(cls, strategy, start_date=None, end_date=None):
+        """
+        Builds the requirements from a Moonshot strategy's DB, DB_FIELDS,
+        DB_TIME_FILTERS, UNIVERSES, CONIDS and COA_CODES parameters.
+        """
+        return cls(
+            strategy.DB,
+            fields=strategy.DB_FIELDS,
+            coa_codes=getattr(strategy, "COA_CODES", None),
+            start_date=start_date,
+            end_date=end_date,
+            conids=strategy.CONIDS,
+            universes=strategy.UNIVERSES,
+            times=strategy.DB_TIME_FILTERS)
+
+    def with_db_universes(self):
+        """
+        Returns a copy scoped to the universes the database was created with,
+        if neither ConIds nor universes are set. The universes stay unset if
+        the database config doesn't list any.
+        """
+        if self.conids or self.universes:
+            return self
+
+        from quantrocket.history import get_db_config
+        dbs = self.db if isinstance(self.db, (list, tuple)) else [self.db]
+        universes = []
+        for db in dbs:
+            universes.extend(get_db_config(db).get("universes") or [])
+
+        requirements = copy.copy(self)
+        requirements.universes = universes or None
+        return requirements
+
+    @property
+    def scoped(self):
+        """
+        True if the requirements are limited to ConIds or universes.
+        """
+        return bool(self.conids or self.universes)
+
+    def conid_blocks(self, block_size=None):
+        """
+        Splits the ConIds into blocks of block_size (a single block of None
+        if not loading by ConId or not splitting).
+        """
+        if not self.conids or not block_size:
+            return [self.conids]
+        conids = list(self.conids)
+        return [conids[i:i+block_size] for i in range(0, len(conids), block_size)]
+
+class PrefetchedData(object):
+    """
+    Assembled prices and financials.
+    """
+
+    def __init__(self, prices=None, financials=None):
+        self.prices = prices
+        self.financials = financials
+
+def _size_connection_pool(max_workers):
+    """
+    Makes sure the shared houston session can keep one connection open per
+    worker thread.
+    """
+    from requests.adapters import HTTPAdapter
+    from quantrocket.houston import houston
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    houston.mount("http://", adapter)
+    houston.mount("https://", adapter)
+
+def _load_prices(requirements, conids):
+    from quantrocket.history import get_historical_prices
+    return get_historical_prices(
+        requirements.db,
+        start_date=requirements.start_date,
+        end_date=requirements.end_date,
+        universes=requirements.universes if not conids else None,
+        conids=conids,
+        times=requirements.times,
+        fields=requirements.fields)
+
+def load_financials(requirements, conids=None):
+    """
+    Downloads the raw Reuters financials (one row per filing) for the
+    requirements' COA codes, limited to conids (default the requirements'
+    ConIds) or else the requirements' universes.
+    """
+    conids = conids or requirements.conids
+    if not conids and not requirements.universes:
+        raise ValueError(
+            "financials requests must be limited to ConIds or universes")
+
+    from quantrocket.fundamental import download_reuters_financials
+
+    start_date = requirements.start_date
+    if start_date:
+        start_date = (pd.Timestamp(start_date) - FINANCIALS_LOOKBACK).date().isoformat()
+
+    f = io.StringIO()
+    download_reuters_financials(
+        requirements.coa_codes, f,
+        conids=conids,
+        universes=requirements.universes if not conids else None,
+        start_date=start_date,
+        end_date=requirements.end_date,
+        fields=["Amount"],
+        interim=requirements.interim)
+    f.seek(0)
+    return pd.read_csv(f, parse_dates=["SourceDate"])
+
+def prefetch(requirements, max_workers=8, block_size=None):
+    """
+    Fetches prices and financials concurrently and assembles them.
+
+    Parameters
+    ----------
+    requirements : DataRequirements
+        the data to load
+
+    max_workers : int
+        maximum number of concurrent requests (default 8)
+
+    block_size : int, optional
+        number of ConIds per request (default one request per data type)
+
+    Returns
+    -------
+    PrefetchedData
+        prices as returned by get_historical_prices and financials as
+        returned by download_reuters_financials (one row per filing)
+    """
+    blocks = requirements.conid_blocks(block_size)
+    _size_connection_pool(max_workers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        price_futures = [
+            executor.submit(_load_prices, requirements, conids)
+            for conids in blocks]
+        financials_futures = []
+        if requirements.coa_codes:
+            financials_futures = [
+                executor.submit(load_financials, requirements, conids)
+                for conids in blocks]
+
+        price_blocks = [future.result() for future in price_futures]
+        financials_blocks = [future.result() for future in financials_futures]
+
+    prices = price_blocks[0] if len(price_blocks) == 1 else pd.concat(price_blocks, axis=1)
+    financials = None
+    if financials_blocks:
+        financials = pd.concat(financials_blocks, ignore_index=True)
+
+    return PrefetchedData(prices=prices, financials=financials)
+
+def reindex_financials_like(financials, reindex_like, coa_codes=None):
+    """
+    Shapes raw financials like a DataFrame of prices, the same way as
+    get_reuters_financials_reindexed_like: values are forward-filled from
+    their SourceDate and shifted one period to avoid lookahead bias.
+
+    Parameters
+    ----------
+    financials : DataFrame
+        raw financials as returned by load_financials or prefetch
+
+    reindex_like : DataFrame
+        a DataFrame with a DatetimeIndex named Date and ConIds as columns,
+        e.g. prices.loc["Close"]
+
+    coa_codes : list of str, optional
+        the codes to include (default all codes in financials)
+
+    Returns
+    -------
+    DataFrame
+        a multiindex (CoaCode, Field, Date) DataFrame of Amounts
+    """
+    financials = financials.rename(columns={"SourceDate": "Date"})
+    if reindex_like.index.tz:
+        financials["Date"] = financials.Date.dt.tz_localize(reindex_like.index.tz)
+
+    union_date_idx = reindex_like.index.union(
+        pd.DatetimeIndex(financials.Date.drop_duplicates())).sort_values()
+    extra_dates = union_date_idx.difference(reindex_like.index)
+
+    coa_codes = coa_codes or list(financials.CoaCode.unique())
+    all_financials = {}
+    for code in coa_codes:
+        financials_for_code = financials.loc[financials.CoaCode == code]
+        if financials_for_code.empty:
+            continue
+
+        # keep only the latest fiscal period if several were reported on
+        # the same date
+        financials_for_code = financials_for_code.drop_duplicates(
+            subset=["ConId", "Date"], keep="last")
+        amounts = financials_for_code.pivot(index="Date", columns="ConId", values="Amount")
+        amounts = amounts.reindex(index=union_date_idx, columns=reindex_like.columns)
+        amounts = amounts.ffill().shift()
+        amounts = amounts.drop(extra_dates)
+        amounts.index.name = "Date"
+
+        all_financials[code] = pd.concat({"Amount": amounts}, names=["Field", "Date"])
+
+    return pd.concat(all_financials, names=["CoaCode", "Field", "Date"])
+
+def lookback_start_date(strategy, start_date):
+    """
+    Returns start_date moved back by the strategy's lookback window, the
+    same way Moonshot extends its price query: LOOKBACK_WINDOW (or the
+    largest *_WINDOW attribute, or 252) trading days converted to calendar
+    days, plus a buffer.
+    """
+    lookback_window = strategy.LOOKBACK_WINDOW
+    if lookback_window is None:
+        windows = [
+            getattr(strategy, attr) for attr in dir(strategy)
+            if attr.endswith("_WINDOW") and attr != "LOOKBACK_WINDOW"]
+        windows = [window for window in windows if isinstance(window, int)]
+        lookback_window = max(windows) if windows else 252
+
+    start_date = pd.Timestamp(start_date) - pd.Timedelta(
+        days=lookback_window*365.0/(260 - 25) + 10)
+    return start_date.date().isoformat()
+
+def _load_strategy_financials(requirements):
+    """
+    Loads financials for a strategy's requirements, scoping them to the
+    database's universes if the strategy sets neither CONIDS nor
+    UNIVERSES. Returns None if they can't be scoped.
+    """
+    requirements = requirements.with_db_universes()
+    if not requirements.scoped:
+        return None
+    return load_financials(requirements)
+
+class FundamentalPrefetchMixin(object):
+    """
+    Moonshot mixin that downloads a strategy's COA_CODES financials in the
+    background while Moonshot loads prices.
+
+    Strategies define COA_CODES and call get_financials_reindexed_like in
+    prices_to_signals instead of get_reuters_financials_reindexed_like.
+
+    Financials are limited to the strategy's CONIDS, else its UNIVERSES,
+    else the universes the database was created with (looked up in the
+    background). If none of these are available, nothing is prefetched and
+    get_financials_reindexed_like falls back to
+    get_reuters_financials_reindexed_like.
+    """
+
+    COA_CODES = None
+    INTERIM_FINANCIALS = False
+
+    _financials_future = None
+
+    def get_historical_prices(self, start_date, end_date=None, **kwargs):
+        self._financials_future = None
+        if self.COA_CODES:
+            # match the lookback Moonshot adds to the price query
+            financials_start_date = start_date
+            if financials_start_date:
+                financials_start_date = lookback_start_date(self, financials_start_date)
+            requirements = DataRequirements.from_strategy(
+                self, start_date=financials_start_date, end_date=end_date)
+            requirements.interim = self.INTERIM_FINANCIALS
+            executor = ThreadPoolExecutor(max_workers=1)
+            self._financials_future = executor.submit(_load_strategy_financials, requirements)
+            executor.shutdown(wait=False)
+
+        return super(FundamentalPrefetchMixin, self).get_historical_prices(
+            start_date, end_date=end_date, **kwargs)
+
+    def get_financials_reindexed_like(self, reindex_like):
+        """
+        Returns the prefetched financials shaped like reindex_like, falling
+        back to get_reuters_financials_reindexed_like if nothing was
+        prefetched.
+        """
+        financials = None
+        if self._financials_future is not None:
+            financials = self._financials_future.result()
+
+        if financials is None:
+            from quantrocket.fundamental import get_reuters_financials_reindexed_like
+            return get_reuters_financials_reindexed_like(
+                reindex_like, self.COA_CODES, interim=self.INTERIM_FINANCIALS)
+
+        return reindex_financials_like(financials, reindex_like, coa_codes=self.COA_CODES)
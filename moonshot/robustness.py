@@ -0,0 +1,220 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Monte Carlo robustness tests on the output of a single Moonshot backtest.
+
+Rather than re-running a strategy (e.g. umd-demo or hml-amex) in a loop,
+this module takes the per-security returns and positions of one run and
+generates thousands of alternative paths as batched array computations:
+
+- block bootstrap: the sequence of dates is resampled in blocks, which
+  preserves short-range autocorrelation
+- rebalance delay: each path's positions are entered a random number of
+  bars late (0 to max_delay), which perturbs the rebalance dates
+
+The per-security matrices are first collapsed into one portfolio return and
+turnover series per possible delay, so each path only needs a row lookup.
+Paths are then generated in chunks sized to stay under a memory budget and
+spread over a process pool.
+
+Usage:
+
+    strategy = UpMinusDownDemo()
+    prices = strategy.get_historical_prices("2005-01-01")
+    signals = strategy.prices_to_signals(prices)
+    weights = strategy.signals_to_target_weights(signals, prices)
+    positions = strategy.target_weights_to_positions(weights, prices)
+
+    # positions_to_gross_returns earns the open-to-open return on the
+    # prior day's position
+    asset_returns = prices.loc["Open"].pct_change()
+    stats = run_robustness(asset_returns, positions.shift(), num_paths=5000, max_delay=2)
+    stats.describe()
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+def delayed_portfolio_series(asset_returns, positions, max_delay=0):
+    """
+    Collapses per-security returns and positions into portfolio return and
+    turnover series for each delay from 0 to max_delay.
+
+    Parameters
+    ----------
+    asset_returns : DataFrame
+        per-security returns, dates as index and securities as columns
+
+    positions : DataFrame
+        positions aligned with asset_returns such that the portfolio return
+        on each date is (asset_returns * positions).sum(axis=1)
+
+    max_delay : int
+        maximum number of bars by which to delay the positions
+
+    Returns
+    -------
+    tuple of ndarray, each shape (max_delay + 1, T)
+        portfolio returns and portfolio turnover by delay
+    """
+    positions = positions.reindex_like(asset_returns)
+    returns = np.nan_to_num(asset_returns.values.astype(np.float64))
+    positions = np.nan_to_num(positions.values.astype(np.float64))
+
+    num_dates = returns.shape[0]
+    portfolio_returns = np.zeros((max_delay + 1, num_dates))
+    turnover = np.zeros((max_delay + 1, num_dates))
+
+    for delay in range(max_delay + 1):
+        delayed = np.zeros_like(positions)
+        delayed[delay:] = positions[:num_dates - delay]
+        portfolio_returns[delay] = (returns * delayed).sum(axis=1)
+        turnover[delay, 1:] = np.abs(np.diff(delayed, axis=0)).sum(axis=1)
+
+    return portfolio_returns, turnover
+
+def block_bootstrap_indices(rng, num_paths, num_dates, block_size):
+    """
+    Returns a (num_paths, num_dates) array of date indices made of randomly
+    placed blocks of consecutive dates (wrapping around at the end).
+    """
+    num_blocks = -(-num_dates // block_size)
+    starts = rng.integers(0, num_dates, size=(num_paths, num_blocks))
+    indices = (starts[:, :, None] + np.arange(block_size)) % num_dates
+    return indices.reshape(num_paths, -1)[:, :num_dates]
+
+def path_statistics(returns, turnover, periods_per_year=252):
+    """
+    Computes Sharpe, CAGR, max drawdown and annualized turnover for each row
+    of a (num_paths, T) matrix of returns.
+    """
+    num_dates = returns.shape[1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sharpes = returns.mean(axis=1) / returns.std(axis=1, ddof=1) * np.sqrt(periods_per_year)
+
+    cum_returns = np.cumprod(1 + returns, axis=1)
+    drawdowns = cum_returns / np.maximum.accumulate(cum_returns, axis=1) - 1
+    cagrs = cum_returns[:, -1] ** (periods_per_year / num_dates) - 1
+
+    return {
+        "Sharpe": sharpes,
+        "CAGR": cagrs,
+        "MaxDrawdown": drawdowns.min(axis=1),
+        "Turnover": turnover.sum(axis=1) * periods_per_year / num_dates,
+    }
+
+def _simulate_chunk(portfolio_returns, turnover, num_paths, block_size, seed, periods_per_year):
+    rng = np.random.default_rng(seed)
+    max_delay, num_dates = portfolio_returns.shape[0] - 1, portfolio_returns.shape[1]
+
+    delays = rng.integers(0, max_delay + 1, size=num_paths)
+    if block_size:
+        indices = block_bootstrap_indices(rng, num_paths, num_dates, block_size)
+    else:
+        indices = np.broadcast_to(np.arange(num_dates), (num_paths, num_dates))
+
+    path_returns = portfolio_returns[delays[:, None], indices]
+    path_turnover = turnover[delays[:, None], indices]
+
+    stats = path_statistics(path_returns, path_turnover, periods_per_year=periods_per_year)
+    stats["Delay"] = delays
+    return stats
+
+def run_robustness(asset_returns, positions, num_paths=1000, block_size=20,
+                   max_delay=0, periods_per_year=252, seed=None, n_jobs=None,
+                   max_chunk_bytes=256*1024**2):
+    """
+    Generates Monte Carlo paths from one backtest's returns and positions and
+    returns the distribution of path statistics.
+
+    Parameters
+    ----------
+    asset_returns : DataFrame
+        per-security returns, dates as index and securities as columns
+
+    positions : DataFrame
+        positions aligned with asset_returns such that the portfolio return
+        on each date is (asset_returns * positions).sum(axis=1)
+
+    num_paths : int
+        number of paths to simulate (default 1000)
+
+    block_size : int
+        bootstrap block length in bars (default 20). Use 0 to keep the
+        original date order (e.g. to test rebalance delays only).
+
+    max_delay : int
+        maximum random delay, in bars, applied to each path's positions
+        (default 0)
+
+    periods_per_year : int
+        bars per year for annualization (default 252)
+
+    seed : int, optional
+        seed for reproducible paths (paths are chunked per worker, so the
+        same seed reproduces the same paths for the same n_jobs)
+
+    n_jobs : int, optional
+        number of worker processes (default os.cpu_count()). Use 1 to
+        simulate in-process.
+
+    max_chunk_bytes : int
+        approximate memory budget per chunk of paths (default 256MB)
+
+    Returns
+    -------
+    DataFrame
+        one row per path with columns Sharpe, CAGR, MaxDrawdown, Turnover and
+        Delay
+    """
+    portfolio_returns, turnover = delayed_portfolio_series(
+        asset_returns, positions, max_delay=max_delay)
+    num_dates = portfolio_returns.shape[1]
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+
+    # index, return and turnover matrices plus cumulative/drawdown
+    # intermediates, all (paths x dates); split the paths at least evenly
+    # over the workers, and further if a worker's share exceeds the budget
+    bytes_per_path = num_dates * 8 * 6
+    chunk_size = max(1, min(
+        max_chunk_bytes // bytes_per_path, -(-num_paths // n_jobs)))
+    chunk_sizes = [chunk_size] * (num_paths // chunk_size)
+    if num_paths % chunk_size:
+        chunk_sizes.append(num_paths % chunk_size)
+
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+
+    if n_jobs == 1 or len(chunk_sizes) == 1:
+        results = [
+            _simulate_chunk(portfolio_returns, turnover, size, block_size, chunk_seed, periods_per_year)
+            for size, chunk_seed in zip(chunk_sizes, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [
+                executor.submit(
+                    _simulate_chunk, portfolio_returns, turnover, size, block_size,
+                    chunk_seed, periods_per_year)
+                for size, chunk_seed in zip(chunk_sizes, seeds)]
+            results = [future.result() for future in futures]
+
+    stats = pd.DataFrame({
+        field: np.concatenate([result[field] for result in results])
+        for field in results[0]})
+    stats.index.name = "Path"
+    return stats
@@ -0,0 +1,222 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Lazy registry of Moonshot strategies.
+
+Finds the strategy class for a CODE (e.g. "dma-tech", "umd-demo",
+"hml-amex") by statically scanning the strategy files in this directory with
+the ast module, so that only the one module which defines the requested CODE
+is imported. The index is cached in a JSON file and a strategy file is only
+re-scanned when its modification time or size changes.
+
+Strategy modules are imported under their codeload package name (e.g.
+codeload.moonshot.dual_moving_average) when the strategy directory lives in
+the codeload directory, so that they share modules with the strategies'
+own codeload imports, and the returned classes can be pickled.
+
+Usage:
+
+    from strategy_registry import StrategyRegistry
+
+    registry = StrategyRegistry()
+    registry.codes()
+    DualMovingAverageTechGiantsStrategy = registry.get("dma-tech")
+"""
+
+import ast
+import glob
+import importlib.util
+import json
+import os
+import sys
+
+DEFAULT_STRATEGY_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_FILENAME = ".strategy_index.json"
+
+def scan_strategy_file(path):
+    """
+    Returns a dict of {CODE: class name} for every class in the file that
+    assigns a string CODE in its class body. The file is parsed but not
+    imported.
+    """
+    with open(path, "rb") as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    codes = {}
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        for stmt in node.body:
+            if not isinstance(stmt, ast.Assign):
+                continue
+            for target in stmt.targets:
+                if (isinstance(target, ast.Name)
+                    and target.id == "CODE"
+                    and isinstance(stmt.value, ast.Constant)
+                    and isinstance(stmt.value.value, str)):
+                    codes[stmt.value.value] = node.name
+    return codes
+
+class StrategyRegistry(object):
+    """
+    Index of Moonshot strategy CODEs to the file and class that define them.
+
+    Parameters
+    ----------
+    strategy_dir : str, optional
+        directory containing the strategy files (default is the directory of
+        this module)
+
+    index_path : str, optional
+        path of the JSON index cache (default .strategy_index.json in
+        strategy_dir). Pass False to disable the on-disk cache.
+    """
+
+    def __init__(self, strategy_dir=None, index_path=None):
+        self.strategy_dir = strategy_dir or DEFAULT_STRATEGY_DIR
+        if index_path is None:
+            index_path = os.path.join(self.strategy_dir, INDEX_FILENAME)
+        self.index_path = index_path
+        self._files = None
+        self._modules = {}
+
+    def _load_cached_index(self):
+        if not self.index_path or not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self, files):
+        if not self.index_path:
+            return
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(files, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            # a read-only strategy directory just means no cache
+            pass
+
+    def refresh(self):
+        """
+        Re-scans new or modified strategy files and updates the index.
+        """
+        cached = self._load_cached_index()
+        files = {}
+        changed = False
+
+        for path in sorted(glob.glob(os.path.join(self.strategy_dir, "*.py"))):
+            filename = os.path.basename(path)
+            stat = os.stat(path)
+            entry = cached.get(filename)
+            if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+                files[filename] = entry
+                continue
+
+            try:
+                codes = scan_strategy_file(path)
+            except SyntaxError:
+                codes = {}
+            files[filename] = {
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "codes": codes,
+            }
+            changed = True
+
+        if changed or set(files) != set(cached):
+            self._save_index(files)
+
+        self._files = files
+        return files
+
+    @property
+    def files(self):
+        if self._files is None:
+            self.refresh()
+        return self._files
+
+    def codes(self):
+        """
+        Returns a dict of {CODE: (filename, class name)}.
+        """
+        codes = {}
+        for filename, entry in self.files.items():
+            for code, classname in entry["codes"].items():
+                if code in codes:
+                    raise ValueError("CODE {0} is defined in both {1} and {2}".format(
+                        code, codes[code][0], filename))
+                codes[code] = (filename, classname)
+        return codes
+
+    def _module_name(self, filename):
+        stem = os.path.splitext(filename)[0]
+        parent_dir = os.path.dirname(self.strategy_dir)
+        if os.path.basename(parent_dir) == "codeload":
+            return "codeload.{0}.{1}".format(os.path.basename(self.strategy_dir), stem)
+        return "_moonshot_strategies_{0}".format(stem)
+
+    def _import(self, filename):
+        if filename in self._modules:
+            return self._modules[filename]
+
+        module_name = self._module_name(filename)
+        if module_name in sys.modules:
+            module = sys.modules[module_name]
+
+        elif module_name.startswith("codeload."):
+            # make codeload importable if it isn't already (QuantRocket puts
+            # it on the path)
+            if importlib.util.find_spec("codeload") is None:
+                sys.path.append(os.path.dirname(os.path.dirname(self.strategy_dir)))
+                importlib.invalidate_caches()
+            module = importlib.import_module(module_name)
+
+        else:
+            path = os.path.join(self.strategy_dir, filename)
+            spec = importlib.util.spec_from_file_location(module_name, path)
+            module = importlib.util.module_from_spec(spec)
+            # register the module before executing it, like a regular
+            # import, so that its classes can be pickled
+            sys.modules[module_name] = module
+            try:
+                spec.loader.exec_module(module)
+            except BaseException:
+                del sys.modules[module_name]
+                raise
+
+        self._modules[filename] = module
+        return module
+
+    def get(self, code):
+        """
+        Returns the strategy class for CODE, importing only the module that
+        defines it.
+        """
+        codes = self.codes()
+        if code not in codes:
+            # the index may be stale if files changed since it was loaded
+            self.refresh()
+            codes = self.codes()
+        if code not in codes:
+            raise KeyError("no strategy with CODE {0} in {1}".format(code, self.strategy_dir))
+
+        filename, classname = codes[code]
+        module = self._import(filename)
+        return getattr(module, classname)
@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import pandas as pd
+from codeload.moonshot.bulk_orders import BulkOrderBuilder
 from moonshot import Moonshot
 
 class TrendDayStrategy(Moonshot):
@@ -79,14 +79,15 @@ class TrendDayStrategy(Moonshot):
 
     def order_stubs_to_orders(self, orders, prices):
 
+        # allocate the parent orders plus one child order per parent
+        builder = BulkOrderBuilder(orders, child_orders=True)
+        builder.set("Exchange", "SMART")
+        builder.set("Tif", "Day")
+
         # enter using market orders
-        orders["Exchange"] = "SMART"
-        orders["OrderType"] = "MKT"
-        orders["Tif"] = "Day"
+        builder.set("OrderType", "MKT", rows=builder.parents)
 
         # exit using MOC orders
-        child_orders = self.orders_to_child_orders(orders)
-        child_orders.loc[:, "OrderType"] = "MOC"
+        builder.set("OrderType", "MOC", rows=builder.children)
 
-        orders = pd.concat([orders, child_orders])
-        return orders
+        return builder.to_frame()
@@ -0,0 +1,254 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batch performance analytics over many backtest results.
+
+After a parameter or strategy sweep, computing tear-sheet statistics one
+result at a time is slower than the sweep itself. This module stacks the
+return series of hundreds of Moonshot or zipline runs into one (dates x
+runs) matrix and computes every statistic with column-wise array operations
+in a single pass. Moonshot dates (tz-naive midnight) and zipline session
+labels (tz-aware UTC, e.g. 21:00) are both normalized to naive session
+dates before stacking. Runs may cover different date ranges; dates outside a
+run are NaN and ignored. Rolling statistics are computed from cumulative
+sums, so their cost doesn't depend on the window length.
+
+Usage:
+
+    returns, exposures, turnover = stack_results({
+        "dma-tech": moonshot_results_1,
+        "dma-etf": moonshot_results_2,
+        "zipline-dma": zipline_perf,
+    })
+    benchmark_returns = prices.loc["Close"]["FIBBG000BDTBL9"].pct_change()
+    stats = compute_stats(returns, exposures, turnover, benchmark_returns)
+    rolling_sharpes = rolling_stats(returns, 252)["Sharpe"]
+"""
+
+import numpy as np
+import pandas as pd
+
+def _to_session_dates(series):
+    """
+    Returns series indexed by tz-naive session dates.
+    """
+    if series is None:
+        return None
+    index = pd.DatetimeIndex(series.index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    series = series.copy()
+    series.index = index.normalize()
+    return series
+
+def _results_to_series(results):
+    """
+    Returns (returns, exposures, turnover) series for one Moonshot results
+    DataFrame, zipline performance DataFrame or returns Series.
+    """
+    if isinstance(results, pd.Series):
+        return results, None, None
+
+    if "Field" in results.index.names:
+        # Moonshot: multiindex (Field, Date) of per-security values
+        returns = results.loc["Return"].sum(axis=1)
+        exposures = results.loc["AbsExposure"].sum(axis=1) if "AbsExposure" in results.index.get_level_values("Field") else None
+        turnover = results.loc["Trade"].abs().sum(axis=1) if "Trade" in results.index.get_level_values("Field") else None
+        return returns, exposures, turnover
+
+    # zipline performance DataFrame
+    exposures = results["gross_leverage"] if "gross_leverage" in results.columns else None
+    return results["returns"], exposures, None
+
+def stack_results(results_by_name):
+    """
+    Stacks backtest results into (dates x runs) matrices.
+
+    Parameters
+    ----------
+    results_by_name : dict
+        dict of run name to a Moonshot results DataFrame, a zipline
+        performance DataFrame, or a Series of returns
+
+    Returns
+    -------
+    tuple of DataFrame
+        returns, exposures and turnover, with one column per run (exposures
+        and turnover are NaN for runs that don't provide them)
+    """
+    returns, exposures, turnover = {}, {}, {}
+    for name, results in results_by_name.items():
+        returns[name], exposures[name], turnover[name] = (
+            _to_session_dates(series) for series in _results_to_series(results))
+
+    returns = pd.DataFrame(returns)
+    exposures = pd.DataFrame({
+        name: series if series is not None else pd.Series(np.nan, index=returns.index)
+        for name, series in exposures.items()}).reindex(returns.index)
+    turnover = pd.DataFrame({
+        name: series if series is not None else pd.Series(np.nan, index=returns.index)
+        for name, series in turnover.items()}).reindex(returns.index)
+    return returns, exposures, turnover
+
+def _nanmean(values, counts):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.nansum(values, axis=0) / counts
+
+def compute_stats(returns, exposures=None, turnover=None, benchmark_returns=None,
+                  periods_per_year=252):
+    """
+    Computes performance statistics for every column of a returns matrix.
+
+    Parameters
+    ----------
+    returns : DataFrame
+        returns with dates as index and one column per run
+
+    exposures : DataFrame, optional
+        gross exposures shaped like returns
+
+    turnover : DataFrame, optional
+        turnover shaped like returns
+
+    benchmark_returns : Series, optional
+        benchmark returns, aligned to returns' dates
+
+    periods_per_year : int
+        periods per year for annualization (default 252)
+
+    Returns
+    -------
+    DataFrame
+        one row per run with columns Periods, CAGR, AnnualVolatility, Sharpe,
+        MaxDrawdown, and when available, Exposure, Turnover, Beta, Alpha,
+        Correlation, TrackingError and InformationRatio
+    """
+    values = returns.values.astype(np.float64)
+    mask = ~np.isnan(values)
+    filled = np.where(mask, values, 0)
+    counts = mask.sum(axis=0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = filled.sum(axis=0) / counts
+        variances = ((filled - means) ** 2 * mask).sum(axis=0) / (counts - 1)
+        stds = np.sqrt(variances)
+
+        cum_returns = np.cumprod(1 + filled, axis=0)
+        cagrs = cum_returns[-1] ** (periods_per_year / counts) - 1
+        drawdowns = cum_returns / np.maximum.accumulate(cum_returns, axis=0) - 1
+
+        stats = {
+            "Periods": counts,
+            "CAGR": cagrs,
+            "AnnualVolatility": stds * np.sqrt(periods_per_year),
+            "Sharpe": means / stds * np.sqrt(periods_per_year),
+            "MaxDrawdown": drawdowns.min(axis=0),
+        }
+
+        if exposures is not None:
+            exposure_values = exposures.reindex_like(returns).values.astype(np.float64)
+            stats["Exposure"] = _nanmean(exposure_values, (~np.isnan(exposure_values)).sum(axis=0))
+
+        if turnover is not None:
+            turnover_values = turnover.reindex_like(returns).values.astype(np.float64)
+            stats["Turnover"] = _nanmean(
+                turnover_values, (~np.isnan(turnover_values)).sum(axis=0)) * periods_per_year
+
+        if benchmark_returns is not None:
+            benchmark = benchmark_returns.reindex(returns.index).values.astype(np.float64)
+            # only compare on dates where both the run and the benchmark
+            # have a return
+            pair_mask = mask & ~np.isnan(benchmark)[:, None]
+            pair_counts = pair_mask.sum(axis=0)
+            run = np.where(pair_mask, values, 0)
+            bench = np.where(pair_mask, benchmark[:, None], 0)
+
+            run_means = run.sum(axis=0) / pair_counts
+            bench_means = bench.sum(axis=0) / pair_counts
+            run_dev = (run - run_means) * pair_mask
+            bench_dev = (bench - bench_means) * pair_mask
+            covs = (run_dev * bench_dev).sum(axis=0) / (pair_counts - 1)
+            bench_vars = (bench_dev ** 2).sum(axis=0) / (pair_counts - 1)
+            run_vars = (run_dev ** 2).sum(axis=0) / (pair_counts - 1)
+
+            betas = covs / bench_vars
+            active = (run - bench) * pair_mask
+            active_means = active.sum(axis=0) / pair_counts
+            tracking_errors = np.sqrt(
+                ((active - active_means) ** 2 * pair_mask).sum(axis=0) / (pair_counts - 1)
+            ) * np.sqrt(periods_per_year)
+
+            stats["Beta"] = betas
+            stats["Alpha"] = (run_means - betas * bench_means) * periods_per_year
+            stats["Correlation"] = covs / np.sqrt(run_vars * bench_vars)
+            stats["TrackingError"] = tracking_errors
+            stats["InformationRatio"] = active_means * periods_per_year / tracking_errors
+
+    return pd.DataFrame(stats, index=returns.columns)
+
+def _rolling_sum(cumsums, window):
+    sums = np.full(cumsums.shape, np.nan)
+    sums[window-1:] = cumsums[window-1:]
+    sums[window:] -= cumsums[:-window]
+    return sums
+
+def rolling_stats(returns, window, periods_per_year=252):
+    """
+    Computes rolling Sharpe, volatility and cumulative return for every
+    column of a returns matrix using cumulative sums.
+
+    Windows containing NaNs use the available returns; windows with fewer
+    than two returns are NaN.
+
+    Parameters
+    ----------
+    returns : DataFrame
+        returns with dates as index and one column per run
+
+    window : int
+        rolling window length in periods
+
+    periods_per_year : int
+        periods per year for annualization (default 252)
+
+    Returns
+    -------
+    dict of DataFrame
+        Sharpe, Volatility and Return, each shaped like returns
+    """
+    values = returns.values.astype(np.float64)
+    mask = ~np.isnan(values)
+    filled = np.where(mask, values, 0)
+
+    counts = _rolling_sum(np.cumsum(mask, axis=0).astype(np.float64), window)
+    sums = _rolling_sum(np.cumsum(filled, axis=0), window)
+    sums_sq = _rolling_sum(np.cumsum(filled ** 2, axis=0), window)
+    log_sums = _rolling_sum(np.cumsum(np.log1p(filled), axis=0), window)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = sums / counts
+        variances = (sums_sq - counts * means ** 2) / (counts - 1)
+        stds = np.sqrt(np.clip(variances, 0, None))
+        stds[counts < 2] = np.nan
+
+        sharpes = means / stds * np.sqrt(periods_per_year)
+        volatilities = stds * np.sqrt(periods_per_year)
+        cum_returns = np.expm1(log_sums)
+
+    return {
+        "Sharpe": pd.DataFrame(sharpes, index=returns.index, columns=returns.columns),
+        "Volatility": pd.DataFrame(volatilities, index=returns.index, columns=returns.columns),
+        "Return": pd.DataFrame(cum_returns, index=returns.index, columns=returns.columns),
+    }
@@ -0,0 +1,215 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for backtest_farm/job_queue.py with a coordinator and several local
+worker processes.
+"""
+
+import multiprocessing
+import os
+import socket
+import sys
+import time
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "backtest_farm"))
+
+from job_queue import Coordinator, Worker, read_message, send_message
+
+def double(job):
+    time.sleep(0.05)
+    return {"value": job["value"] * 2, "pid": os.getpid()}
+
+def crash(job):
+    # simulate a worker machine dying mid-job
+    os._exit(1)
+
+def run_worker(address, worker_id, runner, token=None):
+    Worker(address, worker_id=worker_id, runner=runner, token=token).run()
+
+def start_workers(address, runners, token=None):
+    processes = []
+    for i, runner in enumerate(runners):
+        process = multiprocessing.Process(
+            target=run_worker, args=(address, "worker-{0}".format(i), runner, token))
+        process.start()
+        processes.append(process)
+    return processes
+
+@pytest.fixture
+def coordinator():
+    coordinators = []
+
+    def make(jobs, **kwargs):
+        coordinator = Coordinator(jobs, **kwargs).start()
+        coordinators.append(coordinator)
+        return coordinator
+
+    yield make
+    for coordinator in coordinators:
+        coordinator.stop()
+
+class RawConnection(object):
+    """
+    Talks to the coordinator directly, to send messages a Worker wouldn't.
+    """
+
+    def __init__(self, address):
+        self.sock = socket.create_connection(address, timeout=5)
+        self.rfile = self.sock.makefile("rb")
+        self.wfile = self.sock.makefile("wb")
+
+    def send(self, message):
+        send_message(self.wfile, message)
+
+    def send_raw(self, line):
+        self.wfile.write(line)
+        self.wfile.flush()
+
+    def read(self):
+        return read_message(self.rfile)
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+def test_worker_processes_run_all_jobs(coordinator):
+    jobs = [{"job_id": str(i), "kind": "test", "value": i} for i in range(12)]
+    queue = coordinator(jobs)
+
+    processes = start_workers(queue.address, [double] * 3)
+    results = queue.wait(timeout=30)
+    for process in processes:
+        process.join(10)
+
+    assert sorted(results) == sorted(job["job_id"] for job in jobs)
+    for job_id, result in results.items():
+        assert result["status"] == "ok"
+        assert result["result"]["value"] == int(job_id) * 2
+        assert result["attempts"] == 1
+    assert len(set(result["worker_id"] for result in results.values())) > 1
+    assert all(process.exitcode == 0 for process in processes)
+
+def test_jobs_of_crashed_worker_are_requeued(coordinator):
+    queue = coordinator([{"job_id": "0", "kind": "test", "value": 1}])
+
+    crashed = start_workers(queue.address, [crash])[0]
+    crashed.join(10)
+    assert crashed.exitcode == 1
+
+    healthy = start_workers(queue.address, [double])[0]
+    results = queue.wait(timeout=30)
+    healthy.join(10)
+
+    assert results["0"]["status"] == "ok"
+    assert results["0"]["result"]["value"] == 2
+    assert results["0"]["attempts"] == 2
+
+def test_worker_lost_too_often_is_given_up(coordinator):
+    queue = coordinator([{"job_id": "0", "kind": "test", "value": 1}], max_retries=1)
+
+    for process in start_workers(queue.address, [crash, crash]):
+        process.join(10)
+
+    results = queue.wait(timeout=10)
+    assert results["0"]["status"] == "lost"
+
+@pytest.mark.parametrize("message", [
+    {"type": "request"},
+    {"type": "result", "job_id": "0", "status": "ok"},
+    {"type": "hello"},
+    ["hello"],
+])
+def test_messages_before_hello_are_rejected(coordinator, message):
+    queue = coordinator([{"job_id": "0", "kind": "test", "value": 1}])
+
+    connection = RawConnection(queue.address)
+    connection.send(message)
+    assert connection.read()["type"] == "error"
+    assert connection.read() is None
+    connection.close()
+
+    # the coordinator keeps serving well-behaved workers
+    process = start_workers(queue.address, [double])[0]
+    assert queue.wait(timeout=30)["0"]["status"] == "ok"
+    process.join(10)
+
+def test_result_for_other_job_is_rejected_and_job_requeued(coordinator):
+    queue = coordinator([{"job_id": "0", "kind": "test", "value": 1}])
+
+    connection = RawConnection(queue.address)
+    connection.send({"type": "hello", "worker_id": "raw"})
+    connection.send({"type": "request"})
+    assert connection.read()["job"]["job_id"] == "0"
+    connection.send({"type": "result", "job_id": "unknown", "status": "ok"})
+    assert connection.read()["type"] == "error"
+    assert connection.read() is None
+    connection.close()
+
+    process = start_workers(queue.address, [double])[0]
+    results = queue.wait(timeout=30)
+    process.join(10)
+    assert results["0"]["status"] == "ok"
+    assert results["0"]["attempts"] == 2
+
+@pytest.mark.parametrize("messages", [
+    [{"type": "heartbeat", "job_id": "0"}],
+    [{"type": "request"}, {"type": "request"}],
+    [{"type": "unknown"}],
+])
+def test_out_of_sequence_messages_are_rejected(coordinator, messages):
+    queue = coordinator([{"job_id": "0", "kind": "test", "value": 1}])
+
+    connection = RawConnection(queue.address)
+    connection.send({"type": "hello", "worker_id": "raw"})
+    for message in messages:
+        connection.send(message)
+    reply = connection.read()
+    if reply["type"] == "job":
+        reply = connection.read()
+    assert reply["type"] == "error"
+    connection.close()
+
+def test_invalid_json_closes_connection(coordinator):
+    queue = coordinator([{"job_id": "0", "kind": "test", "value": 1}])
+
+    connection = RawConnection(queue.address)
+    connection.send_raw(b"not json\n")
+    assert connection.read() is None
+    connection.close()
+
+def test_token_is_required(coordinator):
+    queue = coordinator([{"job_id": "0", "kind": "test", "value": 1}], token="secret")
+
+    with pytest.raises(RuntimeError, match="invalid token"):
+        Worker(queue.address, worker_id="intruder", runner=double, token="wrong").run()
+    assert not queue.done
+
+    process = start_workers(queue.address, [double], token="secret")[0]
+    assert queue.wait(timeout=30)["0"]["status"] == "ok"
+    process.join(10)
+
+def test_jobs_prefer_workers_with_cached_db(coordinator):
+    queue = coordinator([
+        {"job_id": "0", "kind": "test", "value": 0, "db": "a"},
+        {"job_id": "1", "kind": "test", "value": 1, "db": "b"},
+    ])
+
+    connection = RawConnection(queue.address)
+    connection.send({"type": "hello", "worker_id": "raw", "cached_dbs": ["b"]})
+    connection.send({"type": "request"})
+    assert connection.read()["job"]["job_id"] == "1"
+    connection.close()
@@ -0,0 +1,318 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for moonshot/prefetch.py. prefetch itself is tested with stand-in
+loaders; the quantrocket client requests are tested against a local
+stand-in for houston when the client is installed.
+"""
+
+import http.server
+import importlib.util
+import os
+import sys
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "moonshot"))
+
+import prefetch as prefetch_module
+from prefetch import (
+    DataRequirements, FundamentalPrefetchMixin, load_financials, prefetch,
+    reindex_financials_like)
+
+requires_client = pytest.mark.skipif(
+    importlib.util.find_spec("quantrocket") is None,
+    reason="requires the quantrocket client")
+
+class StandInHouston(http.server.ThreadingHTTPServer):
+    """
+    Serves Reuters financials, recording each request and the maximum
+    number of concurrent requests.
+    """
+
+    def __init__(self, barrier=None):
+        # if set, each request waits for the barrier's other parties, which
+        # only succeeds if that many requests are in flight at once
+        self.barrier = barrier
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        super(StandInHouston, self).__init__(("127.0.0.1", 0), StandInHandler)
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        # the client sends long ConId lists as form data
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            params.update(urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8")))
+        with server.lock:
+            server.requests.append((url.path, params))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            if server.barrier is not None:
+                server.barrier.wait(timeout=10)
+            conids = params.get("conids", ["1", "2"])
+            rows = ["ConId,CoaCode,Amount,SourceDate"]
+            rows.extend(
+                "{0},{1},{2},2017-12-15".format(conid, code, 100 + int(conid))
+                for conid in conids for code in params["codes"])
+            body = "\n".join(rows)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+@pytest.fixture
+def houston(monkeypatch):
+    servers = []
+
+    def start(**kwargs):
+        server = StandInHouston(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        monkeypatch.setenv("HOUSTON_URL", "http://127.0.0.1:{0}".format(server.server_address[1]))
+        servers.append(server)
+        return server
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def _financials_requests(server):
+    return [params for path, params in server.requests]
+
+@requires_client
+def test_load_financials_scoped_to_conids(houston):
+    server = houston()
+    requirements = DataRequirements(
+        "amex-1d", coa_codes=["ATOT"], start_date="2018-01-01", conids=[1, 2, 3])
+
+    financials = load_financials(requirements)
+
+    assert sorted(financials.ConId.unique()) == [1, 2, 3]
+    params, = _financials_requests(server)
+    assert params["conids"] == ["1", "2", "3"]
+    assert params["start_date"] == ["2016-07-05"]
+
+def test_load_financials_requires_scope():
+    with pytest.raises(ValueError):
+        load_financials(DataRequirements("amex-1d", coa_codes=["ATOT"]))
+
+@requires_client
+def test_financials_blocks_load_concurrently(houston):
+    server = houston(barrier=threading.Barrier(4))
+    requirements = DataRequirements(
+        "amex-1d", coa_codes=["ATOT"], conids=list(range(1, 9)))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(
+            lambda conids: load_financials(requirements, conids),
+            requirements.conid_blocks(2)))
+
+    assert [sorted(result.ConId) for result in results] == [[1, 2], [3, 4], [5, 6], [7, 8]]
+    assert server.max_active == 4
+
+class StandInLoaders(object):
+    """
+    Stand-ins for prefetch's price and financials loaders, recording the
+    ConIds of each request. If barrier is set, each request waits for the
+    barrier's other parties.
+    """
+
+    def __init__(self, barrier=None):
+        self.barrier = barrier
+        self.price_requests = []
+        self.financials_requests = []
+        self.lock = threading.Lock()
+
+    def _wait(self):
+        if self.barrier is not None:
+            self.barrier.wait(timeout=10)
+
+    def load_prices(self, requirements, conids):
+        with self.lock:
+            self.price_requests.append(conids)
+        self._wait()
+        dates = pd.DatetimeIndex(["2018-01-02", "2018-01-03"], name="Date")
+        return pd.concat({
+            field: pd.DataFrame(
+                {conid: [conid * 10.0, conid * 10.0 + 1] for conid in conids or [1, 2]},
+                index=dates)
+            for field in requirements.fields}, names=["Field", "Date"])
+
+    def load_financials(self, requirements, conids=None):
+        with self.lock:
+            self.financials_requests.append(conids)
+        self._wait()
+        return pd.DataFrame({
+            "ConId": list(conids or [1, 2]),
+            "CoaCode": "ATOT",
+            "Amount": [100.0 + conid for conid in conids or [1, 2]],
+            "SourceDate": pd.Timestamp("2017-12-15")})
+
+@pytest.fixture
+def loaders(monkeypatch):
+
+    def install(**kwargs):
+        stand_ins = StandInLoaders(**kwargs)
+        monkeypatch.setattr(prefetch_module, "_load_prices", stand_ins.load_prices)
+        monkeypatch.setattr(prefetch_module, "load_financials", stand_ins.load_financials)
+        monkeypatch.setattr(prefetch_module, "_size_connection_pool", lambda max_workers: None)
+        return stand_ins
+
+    return install
+
+def test_prefetch_loads_prices_and_financials_concurrently(loaders):
+    # 3 price blocks and 3 financials blocks must all be in flight at once
+    stand_ins = loaders(barrier=threading.Barrier(6))
+    requirements = DataRequirements(
+        "amex-1d", fields=["Close"], coa_codes=["ATOT"], conids=[1, 2, 3, 4, 5])
+
+    data = prefetch(requirements, max_workers=6, block_size=2)
+
+    assert sorted(stand_ins.price_requests) == [[1, 2], [3, 4], [5]]
+    assert sorted(stand_ins.financials_requests) == [[1, 2], [3, 4], [5]]
+    assert list(data.prices.columns) == [1, 2, 3, 4, 5]
+    assert data.prices.loc["Close"].loc["2018-01-03"].tolist() == [11.0, 21.0, 31.0, 41.0, 51.0]
+    assert sorted(data.financials.ConId) == [1, 2, 3, 4, 5]
+    assert data.financials.Amount.sum() == 515.0
+
+def test_prefetch_without_blocks_or_financials(loaders):
+    stand_ins = loaders()
+    requirements = DataRequirements("amex-1d", fields=["Open", "Close"], universes=["amex-stk"])
+
+    data = prefetch(requirements)
+
+    assert stand_ins.price_requests == [None]
+    assert stand_ins.financials_requests == []
+    assert data.financials is None
+    assert list(data.prices.index.get_level_values("Field").unique()) == ["Open", "Close"]
+
+def test_prefetch_raises_loader_errors(loaders, monkeypatch):
+    loaders()
+
+    def load_financials(requirements, conids=None):
+        raise ValueError("no financials")
+
+    monkeypatch.setattr(prefetch_module, "load_financials", load_financials)
+    requirements = DataRequirements(
+        "amex-1d", fields=["Close"], coa_codes=["ATOT"], conids=[1, 2])
+
+    with pytest.raises(ValueError, match="no financials"):
+        prefetch(requirements)
+
+class FakeMoonshot(object):
+
+    DB = "amex-1d"
+    DB_FIELDS = None
+    DB_TIME_FILTERS = None
+    CONIDS = None
+    UNIVERSES = None
+    LOOKBACK_WINDOW = None
+
+    def get_historical_prices(self, start_date, end_date=None, **kwargs):
+        return pd.DataFrame(
+            {1: [10.0, 11.0], 2: [20.0, 21.0]},
+            index=pd.DatetimeIndex(["2018-01-02", "2018-01-03"], name="Date"))
+
+class FakeHighMinusLow(FundamentalPrefetchMixin, FakeMoonshot):
+
+    COA_CODES = ["ATOT", "QTCO"]
+
+@requires_client
+def test_mixin_scopes_financials_to_db_universes(houston, monkeypatch):
+    server = houston()
+    db_configs = []
+
+    def get_db_config(code):
+        db_configs.append(code)
+        return {"universes": ["amex-stk"]}
+
+    import quantrocket.history
+    monkeypatch.setattr(quantrocket.history, "get_db_config", get_db_config)
+    strategy = FakeHighMinusLow()
+
+    closes = strategy.get_historical_prices("2018-01-02")
+    financials = strategy.get_financials_reindexed_like(closes)
+
+    assert db_configs == ["amex-1d"]
+    params, = _financials_requests(server)
+    assert params["universes"] == ["amex-stk"]
+    assert "conids" not in params
+    # the filing on 2017-12-15 is known from the first price date on
+    assert financials.loc["ATOT"].loc["Amount"].loc["2018-01-02", 1] == 101
+
+def test_mixin_passes_strategy_conids(loaders):
+    stand_ins = loaders()
+    strategy = FakeHighMinusLow()
+    strategy.CONIDS = [1, 2]
+    strategy.LOOKBACK_WINDOW = 252
+
+    closes = strategy.get_historical_prices("2018-01-02")
+    financials = strategy.get_financials_reindexed_like(closes)
+
+    assert stand_ins.financials_requests == [None]
+    assert financials.loc["ATOT"].loc["Amount"].loc["2018-01-03"].tolist() == [101.0, 102.0]
+
+def test_mixin_moves_financials_start_date_back_by_lookback(monkeypatch):
+    requests = []
+
+    def load_strategy_financials(requirements):
+        requests.append(requirements)
+
+    monkeypatch.setattr(prefetch_module, "_load_strategy_financials", load_strategy_financials)
+    strategy = FakeHighMinusLow()
+    strategy.CONIDS = [1, 2]
+    strategy.LOOKBACK_WINDOW = 252
+    strategy.INTERIM_FINANCIALS = True
+
+    strategy.get_historical_prices("2018-01-02", end_date="2018-06-29")
+    strategy._financials_future.result()
+
+    requirements, = requests
+    assert requirements.start_date == "2016-11-26"
+    assert requirements.end_date == "2018-06-29"
+    assert requirements.conids == [1, 2]
+    assert requirements.coa_codes == ["ATOT", "QTCO"]
+    assert requirements.interim
+
+def test_reindex_financials_like_shifts_source_date():
+    financials = pd.DataFrame({
+        "ConId": [1], "CoaCode": ["ATOT"], "Amount": [5.0],
+        "SourceDate": pd.to_datetime(["2018-01-03"])})
+    closes = pd.DataFrame(
+        {1: [1.0, 1.0, 1.0]},
+        index=pd.DatetimeIndex(["2018-01-02", "2018-01-03", "2018-01-04"], name="Date"))
+
+    amounts = reindex_financials_like(financials, closes).loc["ATOT"].loc["Amount"][1]
+
+    assert amounts.isnull().tolist() == [True, True, False]
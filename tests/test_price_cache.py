@@ -0,0 +1,216 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for backtest_farm/price_cache.py with a stand-in price loader.
+"""
+
+import os
+import socket
+import sys
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "backtest_farm"))
+
+import price_cache
+from price_cache import PriceCacheClient, PriceCacheDaemon, read_message, send_message
+
+class StandInLoader(object):
+    """
+    Returns a small price DataFrame per DB code, counting loads. Loads block
+    until gate is set.
+    """
+
+    def __init__(self):
+        self.loads = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.lock = threading.Lock()
+
+    def __call__(self, codes, fields=None, **query):
+        self.gate.wait()
+        if isinstance(codes, str):
+            codes = [codes]
+        with self.lock:
+            self.loads.append(codes[0])
+        if codes[0] == "bad-db":
+            raise ValueError("no such db")
+        dates = pd.date_range("2018-01-01", periods=50, name="Date")
+        fields = fields or ["Close"]
+        seed = sum(map(ord, codes[0]))
+        return pd.concat({
+            field: pd.DataFrame(
+                np.arange(100.0).reshape(50, 2) + seed, index=dates, columns=[265598, 3691937])
+            for field in fields}, names=["Field", "Date"])
+
+@pytest.fixture(autouse=True)
+def attach_in_process(monkeypatch):
+    # clients share the daemon's process here, so on Python < 3.13 they
+    # must not unregister the daemon's segments from the resource tracker
+    if sys.version_info < (3, 13):
+        monkeypatch.setattr(price_cache, "_attach", lambda name: shared_memory.SharedMemory(name=name))
+
+@pytest.fixture
+def loader():
+    return StandInLoader()
+
+@pytest.fixture
+def daemon(tmp_path, loader):
+    daemons = []
+
+    def make(**kwargs):
+        daemon = PriceCacheDaemon(
+            str(tmp_path / "price_cache{0}.sock".format(len(daemons))), loader=loader, **kwargs).start()
+        daemons.append(daemon)
+        return daemon
+
+    yield make
+    for daemon in daemons:
+        daemon.close()
+
+def test_clients_share_one_copy(daemon, loader):
+    cache = daemon()
+    with PriceCacheClient(cache.socket_path) as client1, PriceCacheClient(cache.socket_path) as client2:
+        prices1 = client1.get_prices("usstock-1d", fields=["Close", "Volume"])
+        prices2 = client2.get_prices("usstock-1d", fields=["Volume", "Close"])
+
+        # equivalent queries share a dataset and were loaded once
+        assert loader.loads == ["usstock-1d"]
+        expected = loader("usstock-1d", fields=["Close", "Volume"])
+        pd.testing.assert_frame_equal(prices1, expected)
+        pd.testing.assert_frame_equal(prices2, expected)
+        assert not prices1.values.flags.writeable
+
+        datasets = client1.stats()["datasets"]
+        assert len(datasets) == 1
+        assert datasets[0]["refs"] == 2
+
+        client1.release(prices1)
+        assert client2.stats()["datasets"][0]["refs"] == 1
+
+def test_disconnect_releases_references(daemon):
+    cache = daemon()
+    client = PriceCacheClient(cache.socket_path)
+    client.get_prices("usstock-1d")
+    client.get_prices("usstock-1d")
+    client.get_prices("etf-1d")
+    client.close()
+
+    with PriceCacheClient(cache.socket_path) as observer:
+        # the daemon releases the references once it notices the disconnect
+        for _ in range(100):
+            refs = [dataset["refs"] for dataset in observer.stats()["datasets"]]
+            if not any(refs):
+                break
+            threading.Event().wait(0.01)
+        assert refs == [0, 0]
+
+def test_evicts_unreferenced_datasets_least_recently_used_first(daemon, loader):
+    cache = daemon()
+    with PriceCacheClient(cache.socket_path) as client:
+        prices = client.get_prices("a-1d")
+        dataset_size = client.stats()["datasets"][0]["bytes"]
+        # room for two datasets
+        cache.memory_budget = dataset_size * 2 + dataset_size // 2
+
+        client.release(prices)
+        client.release(client.get_prices("b-1d"))
+        # use a again, so b is now least recently used
+        client.release(client.get_prices("a-1d"))
+        held = client.get_prices("c-1d")
+
+        datasets = client.stats()["datasets"]
+        assert len(datasets) == 2
+        assert client.stats()["used_bytes"] <= cache.memory_budget
+        loader.loads.clear()
+        client.get_prices("a-1d")
+        assert loader.loads == []
+        client.get_prices("b-1d")
+        assert loader.loads == ["b-1d"]
+
+        # datasets held by clients are never evicted, even over budget
+        held_keys = set(client._attached)
+        assert held_keys <= set(dataset["key"] for dataset in client.stats()["datasets"])
+        assert held.attrs["price_cache_key"] in held_keys
+
+def test_concurrent_requests_load_once(daemon, loader):
+    cache = daemon()
+    loader.gate.clear()
+    clients = [PriceCacheClient(cache.socket_path) for _ in range(4)]
+    results = [None] * len(clients)
+    start = threading.Barrier(len(clients) + 1)
+
+    def get_prices(i):
+        start.wait()
+        results[i] = clients[i].get_prices("usstock-1d")
+
+    threads = [threading.Thread(target=get_prices, args=(i,)) for i in range(len(clients))]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    # give every request a chance to reach the daemon before the load finishes
+    threading.Event().wait(0.2)
+    loader.gate.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert loader.loads == ["usstock-1d"]
+    assert all(result is not None for result in results)
+    assert clients[0].stats()["datasets"][0]["refs"] == 4
+    for client in clients:
+        client.close()
+
+def test_load_error_keeps_connection(daemon):
+    cache = daemon()
+    with PriceCacheClient(cache.socket_path) as client:
+        with pytest.raises(RuntimeError, match="no such db"):
+            client.get_prices("bad-db")
+        with pytest.raises(RuntimeError, match="unsupported query parameters"):
+            client._request({"type": "attach", "query": {"codes": ["x"], "master_fields": ["Symbol"]}})
+        assert client.get_prices("usstock-1d").shape == (50, 2)
+
+@pytest.mark.parametrize("message", [
+    ["attach"],
+    {"type": "attach"},
+    {"type": "attach", "query": "usstock-1d"},
+    {"type": "release"},
+])
+def test_malformed_messages_close_connection(daemon, message):
+    cache = daemon()
+    with PriceCacheClient(cache.socket_path) as client:
+        client.get_prices("usstock-1d")
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(cache.socket_path)
+        rfile, wfile = sock.makefile("rb"), sock.makefile("wb")
+        send_message(wfile, {"type": "attach", "query": {"codes": ["usstock-1d"]}})
+        assert read_message(rfile)["type"] == "attached"
+        send_message(wfile, message)
+        assert read_message(rfile)["type"] == "error"
+        assert read_message(rfile) is None
+        rfile.close()
+        wfile.close()
+        sock.close()
+
+        # the daemon keeps serving, and released the closed connection's
+        # reference
+        for _ in range(100):
+            if client.stats()["datasets"][0]["refs"] == 1:
+                break
+            threading.Event().wait(0.01)
+        assert client.stats()["datasets"][0]["refs"] == 1
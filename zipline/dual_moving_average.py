@@ -22,26 +22,30 @@ its shares once the averages cross again (indicating downwards
 momentum).
 """
 
+import numpy as np
 from zipline.api import order_target_percent, record, symbol, set_benchmark
+from codeload.zipline.history_cache import SharedHistory
 
 
 def initialize(context):
     context.sym = symbol('AAPL')
     set_benchmark(symbol('AAPL'))
-    context.i = 0
+
+    # Keep the 300-day price history in one array that grows by a bar each
+    # day; the 100-day window is served as a view of the same array
+    context.history = SharedHistory('1d')
+    context.history.register(context.sym, 'price', 300)
 
 
 def handle_data(context, data):
     # Skip first 300 days to get full windows
-    context.i += 1
-    if context.i < 300:
+    context.history.advance(data)
+    if not context.history.ready(300):
         return
 
-    # Compute averages
-    # history() has to be called with the same params
-    # from above and returns a pandas dataframe.
-    short_mavg = data.history(context.sym, 'price', 100, '1d').mean()
-    long_mavg = data.history(context.sym, 'price', 300, '1d').mean()
+    # Compute averages (ignoring missing prices, like pandas' mean())
+    short_mavg = np.nanmean(context.history.window(data, context.sym, 'price', 100))
+    long_mavg = np.nanmean(context.history.window(data, context.sym, 'price', 300))
 
     # Trading logic
     if short_mavg > long_mavg:
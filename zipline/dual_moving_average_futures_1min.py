@@ -23,6 +23,7 @@ average and sell when the short moving average is below the long moving
 average.
 """
 
+import os
 from zipline.api import (
     continuous_future,
     order_target_percent,
@@ -32,8 +33,14 @@ from zipline.api import (
     set_commission,
     set_slippage,
     get_open_orders,
-    cancel_order
+    cancel_order,
+    get_datetime
 )
+from codeload.zipline.recorder import ColumnarRecorder
+
+# Directory to write the recorded minute values to, downsampled to daily
+# open/high/low/close
+RECORDER_DIR = "/codeload/zipline/recorded/dual_moving_average_futures_1min"
 
 def initialize(context):
     context.fut = continuous_future('ES', roll='calendar')
@@ -44,6 +51,15 @@ def initialize(context):
 
     context.i = 0
     context.invested = False
+    context.session = None
+    context.session_close = None
+
+    # Record minute values into compact column arrays, downsampled to
+    # open/high/low/close per trading session (ES sessions span two
+    # calendar days)
+    context.recorder = ColumnarRecorder(
+        path=RECORDER_DIR, downsample="ohlc",
+        session_label=context.trading_calendar.minute_to_session_label)
 
 def handle_data(context, data):
 
@@ -82,6 +98,22 @@ def handle_data(context, data):
         context.invested = False
 
     # Save values for later inspection
-    record(current_price=data.current(context.fut, "price"),
-           short_mavg=short_mavg,
-           long_mavg=long_mavg)
+    dt = get_datetime()
+    # ES sessions open the evening before, so bars arrive before
+    # before_trading_start; look up the session close from the bar itself
+    session = context.trading_calendar.minute_to_session_label(dt)
+    if session != context.session:
+        context.session = session
+        context.session_close = context.trading_calendar.session_close(session)
+    context.recorder.record(dt,
+                            current_price=data.current(context.fut, "price"),
+                            short_mavg=short_mavg,
+                            long_mavg=long_mavg)
+
+    # On the session's last bar, pass the latest values on to zipline
+    # (daily performance output only keeps the last value anyway)
+    if dt == context.session_close:
+        record(**context.recorder.last())
+
+def analyze(context, perf):
+    context.recorder.to_frame().to_csv(os.path.join(RECORDER_DIR, "ohlc.csv"))
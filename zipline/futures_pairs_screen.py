@@ -0,0 +1,254 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batched pair screening for a universe of continuous futures.
+
+futures_pairs_trading.py trades a single hardcoded pair (CL/RB) and runs
+one linregress per day. This module computes the same statistics for all
+N x N ordered pairs of a universe at once:
+
+- the rolling hedge ratio of each pair's returns (the linregress slope)
+- the z-score of the current return spread, as in calc_spread_zscore
+- an Engle-Granger cointegration t-statistic and half-life on log prices
+
+Rolling means and covariances are computed from cumulative sums over the
+whole returns matrix, and the work is split into blocks of "y" legs that
+are processed in parallel across cores.
+
+Usage, e.g. in a notebook or in before_trading_start:
+
+    prices = data.history(futures, 'price', 500, '1d')
+    candidates = screen_pairs(prices, long_window=65, short_window=5)
+    candidates.head(10)
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# MacKinnon (2010) 5% critical value for the two-variable Engle-Granger test
+# with a constant
+EG_CRITICAL_VALUE_5PCT = -3.34
+
+def _rolling_sum(cumsums, window):
+    """
+    Returns the trailing window sums along axis 0 given cumulative sums
+    (with a leading row of zeros). The first window-1 rows are NaN.
+    """
+    sums = np.full(cumsums[1:].shape, np.nan)
+    sums[window-1:] = cumsums[window:] - cumsums[:-window]
+    return sums
+
+def _with_leading_zeros(cumsums):
+    return np.concatenate([np.zeros((1,) + cumsums.shape[1:]), cumsums])
+
+def rolling_pair_stats(returns, long_window, short_window, rows=None):
+    """
+    Computes rolling hedge ratios and spread z-scores for pairs of return
+    series.
+
+    Parameters
+    ----------
+    returns : ndarray, shape (T, N)
+        matrix of returns without NaNs
+
+    long_window : int
+        window for the hedge ratio and the spread mean/std
+
+    short_window : int
+        window for the current spread mean
+
+    rows : ndarray of int, optional
+        indices of the "y" legs to compute (default all)
+
+    Returns
+    -------
+    tuple of ndarray, each shape (T, len(rows), N)
+        hedge ratios (slope of y on x) and spread z-scores, where the spread
+        is y - hedge_ratio * x
+    """
+    if rows is None:
+        rows = np.arange(returns.shape[1])
+
+    x = returns
+    y = returns[:, rows]
+
+    cum_x = _with_leading_zeros(np.cumsum(x, axis=0))
+    cum_xx = _with_leading_zeros(np.cumsum(x * x, axis=0))
+    cum_xy = _with_leading_zeros(np.cumsum(y[:, :, None] * x[:, None, :], axis=0))
+
+    n = long_window
+    mean_x = _rolling_sum(cum_x, n)[:, None, :] / n
+    mean_y = _rolling_sum(cum_x[:, rows], n)[:, :, None] / n
+    var_x = _rolling_sum(cum_xx, n)[:, None, :] / n - mean_x ** 2
+    var_y = _rolling_sum(cum_xx[:, rows], n)[:, :, None] / n - mean_y ** 2
+    cov_xy = _rolling_sum(cum_xy, n) / n - mean_y * mean_x
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        hedge_ratios = cov_xy / var_x
+
+        # mean and std (ddof=1) of the spread over the long window, holding
+        # the hedge ratio fixed at its current value
+        spread_mean = mean_y - hedge_ratios * mean_x
+        spread_var = var_y + hedge_ratios ** 2 * var_x - 2 * hedge_ratios * cov_xy
+        spread_std = np.sqrt(np.clip(spread_var, 0, None) * n / (n - 1))
+
+        short_mean_x = _rolling_sum(cum_x, short_window)[:, None, :] / short_window
+        short_mean_y = _rolling_sum(cum_x[:, rows], short_window)[:, :, None] / short_window
+        short_spread_mean = short_mean_y - hedge_ratios * short_mean_x
+
+        zscores = (short_spread_mean - spread_mean) / spread_std
+
+    return hedge_ratios, zscores
+
+def cointegration_stats(log_prices, rows=None):
+    """
+    Computes the Engle-Granger cointegration t-statistic and the spread
+    half-life for pairs of log price series.
+
+    For each pair, y is regressed on x with a constant, and a Dickey-Fuller
+    regression without lags is run on the residuals.
+
+    Parameters
+    ----------
+    log_prices : ndarray, shape (T, N)
+        matrix of log prices without NaNs
+
+    rows : ndarray of int, optional
+        indices of the "y" legs to compute (default all)
+
+    Returns
+    -------
+    tuple of ndarray, each shape (len(rows), N)
+        t-statistics and half-lives (in bars)
+    """
+    if rows is None:
+        rows = np.arange(log_prices.shape[1])
+
+    x = log_prices - log_prices.mean(axis=0)
+    y = x[:, rows]
+
+    var_x = (x * x).sum(axis=0)
+    cov_xy = np.einsum("ti,tj->ij", y, x)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        betas = cov_xy / var_x[None, :]
+
+    # residuals of each pair's regression, shape (T, rows, N)
+    residuals = y[:, :, None] - betas[None, :, :] * x[:, None, :]
+
+    lagged = residuals[:-1]
+    diffs = residuals[1:] - lagged
+    sum_lagged_sq = (lagged * lagged).sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gammas = (diffs * lagged).sum(axis=0) / sum_lagged_sq
+        sse = ((diffs - gammas[None] * lagged) ** 2).sum(axis=0)
+        sigma_sq = sse / (diffs.shape[0] - 1)
+        tstats = gammas / np.sqrt(sigma_sq / sum_lagged_sq)
+        half_lives = -np.log(2) / np.log1p(gammas)
+
+    # no mean reversion, or a full reversion within one bar
+    half_lives[gammas >= 0] = np.inf
+    half_lives[gammas <= -1] = 0
+    return tstats, half_lives
+
+def _screen_block(returns, log_prices, rows, long_window, short_window):
+    hedge_ratios, zscores = rolling_pair_stats(returns, long_window, short_window, rows=rows)
+    tstats, half_lives = cointegration_stats(log_prices, rows=rows)
+    return rows, hedge_ratios[-1], zscores[-1], tstats, half_lives
+
+def screen_pairs(prices, long_window=65, short_window=5, n_jobs=None, block_size=None):
+    """
+    Screens all ordered pairs of a universe of futures and ranks them by
+    cointegration t-statistic.
+
+    Parameters
+    ----------
+    prices : DataFrame
+        prices with dates as the index and one column per continuous future,
+        as returned by data.history(futures, 'price', bar_count, '1d'). Dates
+        where any future has a missing price are dropped.
+
+    long_window : int
+        window for the hedge ratio and spread statistics (default 65)
+
+    short_window : int
+        window for the current spread mean (default 5)
+
+    n_jobs : int, optional
+        number of worker processes (default os.cpu_count()). Use 1 to compute
+        in-process.
+
+    block_size : int, optional
+        number of "y" legs per parallel block (default N / n_jobs)
+
+    Returns
+    -------
+    DataFrame
+        one row per ordered pair (y, x), sorted from most to least
+        cointegrated, with columns HedgeRatio, ZScore, CointTStat, HalfLife
+        and Cointegrated (t-statistic below the 5% critical value)
+    """
+    prices = prices.dropna()
+    if len(prices) <= long_window:
+        raise ValueError("need more than long_window ({0}) complete rows of prices, got {1}".format(
+            long_window, len(prices)))
+
+    values = prices.values.astype(np.float64)
+    log_prices = np.log(values)
+    # drop the first row so returns and log prices have the same length
+    returns = values[1:] / values[:-1] - 1
+    log_prices = log_prices[1:]
+
+    num_assets = values.shape[1]
+    n_jobs = n_jobs or os.cpu_count() or 1
+    block_size = block_size or max(1, int(np.ceil(num_assets / n_jobs)))
+    blocks = [np.arange(start, min(start + block_size, num_assets))
+              for start in range(0, num_assets, block_size)]
+
+    hedge_ratios = np.empty((num_assets, num_assets))
+    zscores = np.empty((num_assets, num_assets))
+    tstats = np.empty((num_assets, num_assets))
+    half_lives = np.empty((num_assets, num_assets))
+
+    if n_jobs == 1 or len(blocks) == 1:
+        results = [
+            _screen_block(returns, log_prices, rows, long_window, short_window)
+            for rows in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [
+                executor.submit(_screen_block, returns, log_prices, rows, long_window, short_window)
+                for rows in blocks]
+            results = [future.result() for future in futures]
+
+    for rows, block_hedge_ratios, block_zscores, block_tstats, block_half_lives in results:
+        hedge_ratios[rows] = block_hedge_ratios
+        zscores[rows] = block_zscores
+        tstats[rows] = block_tstats
+        half_lives[rows] = block_half_lives
+
+    y_idx, x_idx = np.where(~np.eye(num_assets, dtype=bool))
+    candidates = pd.DataFrame({
+        "Y": prices.columns[y_idx],
+        "X": prices.columns[x_idx],
+        "HedgeRatio": hedge_ratios[y_idx, x_idx],
+        "ZScore": zscores[y_idx, x_idx],
+        "CointTStat": tstats[y_idx, x_idx],
+        "HalfLife": half_lives[y_idx, x_idx],
+    })
+    candidates["Cointegrated"] = candidates.CointTStat < EG_CRITICAL_VALUE_5PCT
+    candidates = candidates.sort_values("CointTStat").reset_index(drop=True)
+    return candidates
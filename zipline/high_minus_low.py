@@ -18,6 +18,8 @@ from zipline.api import (
     order_target_percent,
     get_open_orders,
     cancel_order,
+    get_datetime,
+    get_environment,
     pipeline_output,
     record,
     schedule_function,
@@ -37,6 +39,18 @@ ratio) and shorts the top 3 growth stocks (= high price-to-book ratio) using
 Reuters financials
 """
 
+# Directory of pipeline output precomputed with
+# pipeline_cache.precompute_pipeline, or None to compute the pipeline
+# during the backtest
+PIPELINE_CACHE_DIR = None
+# Bundle and universe used by make_engine to precompute the pipeline from
+# point-in-time Reuters financials
+BUNDLE = "amex-1d"
+UNIVERSE = "amex-stk"
+# How far before the start date to download statements, so the latest
+# annual filing known at the start date is included
+FUNDAMENTALS_LOOKBACK = "730D"
+
 # Create a price-to-book custom pipeline factor
 class PriceBookRatio(CustomFactor):
     """
@@ -52,6 +66,14 @@ class PriceBookRatio(CustomFactor):
     Price-to-book ratio is then calculated as:
 
         closing price / book value per share
+
+    During `zipline run` the ReutersFinancials inputs come from QuantRocket's
+    loader. To compute them from a point-in-time index of filings instead,
+    precompute the pipeline with make_engine and set PIPELINE_CACHE_DIR:
+
+        fundamentals = load_fundamentals(start_date, end_date)
+        precompute_pipeline(make_engine, make_pipeline, start_date, end_date, path,
+                            engine_args=(fundamentals,))
     """
     inputs = [
         USEquityPricing.close, # despite the name, this works fine for non-US equities too
@@ -108,12 +130,49 @@ def rebalance(context, data):
 
         order_target_percent(asset, 0)
 
-def initialize(context):
-    pipe = Pipeline()
-    attach_pipeline(pipe, 'my_pipeline')
+def load_fundamentals(start_date, end_date):
+    """
+    Downloads the Reuters financials PriceBookRatio needs between
+    start_date (less FUNDAMENTALS_LOOKBACK) and end_date into a
+    point-in-time index. Call once and pass the index to make_engine.
+    """
+    import pandas as pd
+    from codeload.zipline.pit_fundamentals import PointInTimeFundamentals
+
+    start_date = pd.Timestamp(start_date) - pd.Timedelta(FUNDAMENTALS_LOOKBACK)
+    return PointInTimeFundamentals.from_reuters_financials(
+        ["ATOT", "LTLL", "QTCO"], universes=UNIVERSE,
+        start_date=start_date.strftime("%Y-%m-%d"),
+        end_date=pd.Timestamp(end_date).strftime("%Y-%m-%d"))
 
+def make_engine(fundamentals):
+    """
+    Returns a pipeline engine that serves the ReutersFinancials inputs of
+    PriceBookRatio from the point-in-time index returned by
+    load_fundamentals, for use with pipeline_cache.precompute_pipeline.
+    """
+    from codeload.zipline.pit_fundamentals import (
+        PointInTimeFundamentalsLoader, make_pipeline_engine)
+
+    return make_pipeline_engine(BUNDLE, PointInTimeFundamentalsLoader(fundamentals))
+
+def make_pipeline():
+    pipe = Pipeline()
     pb_ratios = PriceBookRatio()
     pipe.add(pb_ratios, 'pb_ratio')
+    return pipe
+
+def initialize(context):
+    pipeline = make_pipeline()
+    attach_pipeline(pipeline, 'my_pipeline')
+
+    context.pipeline_cache = None
+    if PIPELINE_CACHE_DIR:
+        from codeload.zipline.pipeline_cache import load_pipeline_cache
+        # fails if the cache is stale or doesn't cover the backtest
+        context.pipeline_cache = load_pipeline_cache(
+            PIPELINE_CACHE_DIR, pipeline,
+            get_environment('start'), get_environment('end'))
 
     # If Zipline has trouble pulling the default benchmark, try setting the
     # benchmark to something already in your bundle
@@ -125,4 +184,7 @@ def initialize(context):
     context.set_commission(commission.PerShare(cost=.0075, min_trade_cost=1.0))
 
 def before_trading_start(context, data):
-    context.pipeline_data = pipeline_output('my_pipeline')
+    if context.pipeline_cache is not None:
+        context.pipeline_data = context.pipeline_cache.output(get_datetime())
+    else:
+        context.pipeline_data = pipeline_output('my_pipeline')
@@ -0,0 +1,166 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Shared sliding-window history for daily zipline algorithms.
+
+dual_moving_average.py calls data.history() twice per bar, once for 100
+bars and once for 300 bars of the same series, and counts bars by hand to
+skip the warm-up period. SharedHistory keeps one contiguous NumPy array per
+registered (asset, field) for the whole backtest and serves every window as
+a zero-copy view of its tail. It also counts bars, so warm-up readiness can
+be checked directly.
+
+The array is loaded from data.history() once and then extended with each
+new bar, fetched together with the bar before it. data.history() returns
+prices adjusted for splits and dividends as of the current simulation date,
+so when that previous bar no longer matches the cached value, an
+adjustment took effect and the array is reloaded; this only happens on the
+asset's ex-dates.
+
+Usage:
+
+    def initialize(context):
+        context.history = SharedHistory('1d')
+        context.history.register(context.sym, 'price', 300)
+
+    def handle_data(context, data):
+        context.history.advance(data)
+        if not context.history.ready(300):
+            return
+        short_prices = context.history.window(data, context.sym, 'price', 100)
+        long_prices = context.history.window(data, context.sym, 'price', 300)
+"""
+
+import numpy as np
+
+class _Series(object):
+    """
+    Growable array holding the cached values of one (asset, field).
+    """
+
+    def __init__(self, values, bar_count, loaded_bar):
+        self.bar_count = bar_count
+        self.buffer = np.empty(self._capacity(bar_count), dtype=values.dtype)
+        self.buffer[:len(values)] = values
+        self.end = len(values)
+        self.loaded_bar = loaded_bar
+
+    @staticmethod
+    def _capacity(bar_count):
+        return max(2 * bar_count, bar_count + 252)
+
+    @property
+    def last(self):
+        return self.buffer[self.end-1:self.end]
+
+    def extend(self, values):
+        if self.end + len(values) > len(self.buffer):
+            # copy the tail to a new buffer rather than shifting in place, so
+            # views handed out earlier keep their values
+            tail = self.buffer[self.end-self.bar_count:self.end]
+            self.buffer = np.empty(
+                self._capacity(self.bar_count) + len(values), dtype=self.buffer.dtype)
+            self.buffer[:len(tail)] = tail
+            self.end = len(tail)
+        self.buffer[self.end:self.end+len(values)] = values
+        self.end += len(values)
+
+    def tail(self, bar_count):
+        view = self.buffer[max(0, self.end-bar_count):self.end]
+        view.flags.writeable = False
+        return view
+
+class SharedHistory(object):
+    """
+    Backtest-long cache of history windows.
+
+    Parameters
+    ----------
+    frequency : str
+        the history frequency, '1d' or '1m' (default '1d')
+    """
+
+    def __init__(self, frequency='1d'):
+        self.frequency = frequency
+        self.bars = 0
+        self.reloads = 0
+        self._bar_counts = {}
+        self._series = {}
+
+    def register(self, asset, field, bar_count):
+        """
+        Declares that windows of up to bar_count bars will be requested for
+        (asset, field). Registering a longer window reloads the cached one.
+        """
+        key = (asset, field)
+        if bar_count > self._bar_counts.get(key, 0):
+            self._bar_counts[key] = bar_count
+            self._series.pop(key, None)
+
+    def advance(self, data):
+        """
+        Marks the start of a new bar. Call once at the top of handle_data.
+        """
+        self.bars += 1
+
+    def ready(self, bar_count):
+        """
+        Returns True once at least bar_count bars have been seen, i.e. once a
+        full window of bar_count bars is available from the backtest. Bars
+        are counted for the backtest as a whole, not per asset.
+        """
+        return self.bars >= bar_count
+
+    def _load(self, data, key):
+        asset, field = key
+        bar_count = self._bar_counts[key]
+        values = np.asarray(data.history(asset, field, bar_count, self.frequency).values)
+        self._series[key] = _Series(values, bar_count, self.bars)
+        self.reloads += 1
+
+    def _update(self, data, key):
+        """
+        Brings the cached array of key up to the current bar.
+        """
+        series = self._series.get(key)
+        if series is None:
+            self._load(data, key)
+            return
+
+        new_bars = self.bars - series.loaded_bar
+        if new_bars == 0:
+            return
+        if new_bars >= series.bar_count:
+            self._load(data, key)
+            return
+
+        asset, field = key
+        values = np.asarray(data.history(asset, field, new_bars + 1, self.frequency).values)
+        if not np.array_equal(values[:1], series.last, equal_nan=True):
+            # a split or dividend adjusted the earlier bars
+            self._load(data, key)
+            return
+        series.extend(values[1:])
+        series.loaded_bar = self.bars
+
+    def window(self, data, asset, field, bar_count):
+        """
+        Returns the last bar_count values of (asset, field) as a read-only
+        view of the cached array.
+        """
+        key = (asset, field)
+        self.register(asset, field, bar_count)
+        self._update(data, key)
+        return self._series[key].tail(bar_count)
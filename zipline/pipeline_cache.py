@@ -0,0 +1,407 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Precomputed pipeline output for pipeline algorithms.
+
+During a backtest, zipline computes pipelines such as Momentum().deciles()
+in up_minus_down.py or PriceBookRatio in high_minus_low.py in sequential
+date chunks on a single core. precompute_pipeline instead splits the
+backtest range into date partitions and runs each one on its own engine in a
+process pool; each partition loads its own window warm-up, since
+run_pipeline always loads window_length extra rows before the start date.
+
+The output is stored as one memory-mapped (dates x assets) array per
+pipeline column plus a mask of which assets were in the output on each date.
+Every session in the range gets a row, even if its output was empty.
+PipelineCache.output(date) then returns a day's pipeline output with a
+dictionary lookup and a row slice, without computing anything.
+
+The cache also records a fingerprint of the pipeline definition (terms,
+window lengths, parameters and the code and module-level constants of
+custom factors) and the date range it covers. load_pipeline_cache refuses a
+cache that was computed for a different pipeline or doesn't cover the
+backtest, rather than silently serving stale output.
+
+Precompute (e.g. in a notebook):
+
+    precompute_pipeline(
+        make_engine, make_pipeline, "2010-01-04", "2017-12-29",
+        "/codeload/pipeline_cache/umd")
+
+where make_engine and make_pipeline are module-level functions (so they can
+be sent to worker processes) returning a SimplePipelineEngine and the
+algorithm's Pipeline. Data that every engine needs and that is expensive to
+fetch (such as fundamentals) can be loaded once in the parent and passed to
+make_engine through engine_args. Partition boundaries and cache rows follow the
+trading calendar's sessions (NYSE by default). Then set PIPELINE_CACHE_DIR
+in the algorithm.
+"""
+
+import hashlib
+import json
+import os
+import types
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+META_FILENAME = "meta.json"
+MASK_FILENAME = "mask.dat"
+
+def _column_filename(column):
+    return "column_{0}.dat".format(column)
+
+def _storage_shape(num_dates, num_sids):
+    # memmaps can't be empty, so pad to at least one row and column
+    return (max(num_dates, 1), max(num_sids, 1))
+
+def _run_partition(make_engine, make_pipeline, start_date, end_date, engine_args=()):
+    engine = make_engine(*engine_args)
+    return engine.run_pipeline(make_pipeline(), start_date, end_date)
+
+def get_sessions(start_date, end_date, sessions=None, calendar_name="NYSE"):
+    """
+    Returns the trading sessions between start_date and end_date, taken from
+    sessions if given, otherwise from the named trading calendar.
+    """
+    if sessions is None:
+        from zipline.utils.calendars import get_calendar
+        return get_calendar(calendar_name).sessions_in_range(
+            pd.Timestamp(start_date, tz="UTC"), pd.Timestamp(end_date, tz="UTC"))
+
+    sessions = pd.DatetimeIndex(sessions)
+    return sessions[(sessions >= pd.Timestamp(start_date, tz=sessions.tz))
+                    & (sessions <= pd.Timestamp(end_date, tz=sessions.tz))]
+
+def partition_dates(start_date, end_date, partitions, sessions=None, calendar_name="NYSE"):
+    """
+    Splits the sessions between start_date and end_date into contiguous
+    (start, end) partitions, so that every partition starts and ends on a
+    trading day.
+    """
+    sessions = get_sessions(start_date, end_date, sessions, calendar_name)
+    chunks = np.array_split(np.arange(len(sessions)), min(partitions, len(sessions)))
+    return [(sessions[chunk[0]], sessions[chunk[-1]]) for chunk in chunks if len(chunk)]
+
+def _code_hash(code):
+    """
+    Returns a hash of a code object's bytecode and constants, hashing
+    nested code objects (comprehensions, lambdas) the same way rather than
+    by their repr, which contains a memory address.
+    """
+    sha = hashlib.sha1(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            sha.update(_code_hash(const).encode("utf-8"))
+        else:
+            sha.update(repr(const).encode("utf-8"))
+    return sha.hexdigest()
+
+def _code_names(code):
+    """
+    Returns the global names used by a code object and its nested code
+    objects.
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+def _term_description(term):
+    """
+    Returns a JSON-serializable description of a pipeline term and its
+    inputs, used to fingerprint the pipeline definition.
+    """
+    term_type = type(term)
+    # the class name only, since the algorithm's module name differs between
+    # zipline run and importing it to precompute
+    description = {"type": term_type.__qualname__}
+
+    qualname = getattr(term, "qualname", None)
+    if qualname:
+        # a BoundColumn such as USEquityPricing.close
+        description["column"] = qualname
+        return description
+
+    for attr in ("window_length", "dtype", "missing_value"):
+        if hasattr(term, attr):
+            description[attr] = repr(getattr(term, attr))
+
+    params = getattr(term, "params", None)
+    if params:
+        description["params"] = sorted((key, repr(value)) for key, value in dict(params).items())
+
+    description["inputs"] = [_term_description(term_input) for term_input in getattr(term, "inputs", ())]
+
+    mask = getattr(term, "mask", None)
+    if mask is not None and type(mask).__name__ != "AssetExists":
+        description["mask"] = _term_description(mask)
+
+    compute = getattr(term_type, "compute", None)
+    if compute is not None and not term_type.__module__.startswith("zipline."):
+        # custom factors: hash the compute code along with any module-level
+        # constants it uses, such as RANKING_PERIOD_GAP
+        code = compute.__code__
+        description["code"] = _code_hash(code)
+        description["globals"] = sorted(
+            (name, repr(compute.__globals__[name])) for name in _code_names(code)
+            if isinstance(compute.__globals__.get(name), (bool, int, float, str)))
+
+    return description
+
+def pipeline_fingerprint(pipeline):
+    """
+    Returns a hash of a Pipeline's columns and screen.
+    """
+    description = {
+        "columns": {name: _term_description(term) for name, term in pipeline.columns.items()},
+        "screen": _term_description(pipeline.screen) if pipeline.screen is not None else None,
+    }
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+def precompute_pipeline(make_engine, make_pipeline, start_date, end_date, path,
+                        partitions=None, max_workers=None, sessions=None,
+                        calendar_name="NYSE", engine_args=()):
+    """
+    Computes pipeline output for a date range in parallel partitions and
+    stores it as memory-mapped arrays.
+
+    Parameters
+    ----------
+    make_engine : callable
+        module-level function returning a pipeline engine, called with
+        engine_args in each worker
+
+    make_pipeline : callable
+        module-level function returning the Pipeline
+
+    start_date, end_date : str or Timestamp
+        the backtest date range
+
+    path : str
+        directory to write the output to
+
+    partitions : int, optional
+        number of date partitions (default max_workers)
+
+    max_workers : int, optional
+        number of worker processes (default os.cpu_count())
+
+    sessions : DatetimeIndex, optional
+        trading sessions to compute (default the sessions of calendar_name)
+
+    calendar_name : str
+        trading calendar whose sessions are used if sessions is not given
+        (default NYSE)
+
+    engine_args : tuple, optional
+        picklable arguments for make_engine, loaded once in the parent
+        rather than in every worker
+
+    Returns
+    -------
+    PipelineCache
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    partitions = partitions or max_workers
+    sessions = get_sessions(start_date, end_date, sessions, calendar_name)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_run_partition, make_engine, make_pipeline, start, end, engine_args)
+            for start, end in partition_dates(start_date, end_date, partitions, sessions)]
+        outputs = [future.result() for future in futures]
+
+    output = pd.concat(outputs)
+    write_pipeline_output(output, path, sessions=sessions, pipeline=make_pipeline())
+    return PipelineCache(path)
+
+def write_pipeline_output(output, path, sessions=None, pipeline=None):
+    """
+    Writes a (date, asset) multiindex DataFrame of pipeline output to path.
+
+    Parameters
+    ----------
+    output : DataFrame
+        the pipeline output
+
+    path : str
+        directory to write the output to
+
+    sessions : DatetimeIndex, optional
+        sessions to store a row for, including those with empty output
+        (default the dates in output)
+
+    pipeline : Pipeline, optional
+        the pipeline that produced output, fingerprinted so that stale caches
+        can be detected
+    """
+    os.makedirs(path, exist_ok=True)
+
+    dates = output.index.get_level_values(0)
+    assets = output.index.get_level_values(1)
+    sids = np.array([int(getattr(asset, "sid", asset)) for asset in assets], dtype=np.int64)
+
+    unique_dates = pd.DatetimeIndex(dates.unique())
+    if sessions is not None:
+        sessions = pd.DatetimeIndex(sessions)
+        if sessions.tz is None and unique_dates.tz is not None:
+            sessions = sessions.tz_localize(unique_dates.tz)
+        elif sessions.tz is not None and unique_dates.tz is None:
+            sessions = sessions.tz_convert(None)
+        unique_dates = unique_dates.union(sessions)
+    unique_dates = unique_dates.sort_values()
+    unique_sids = np.unique(sids)
+    rows = unique_dates.get_indexer(dates)
+    cols = np.searchsorted(unique_sids, sids)
+    shape = _storage_shape(len(unique_dates), len(unique_sids))
+
+    mask = np.memmap(os.path.join(path, MASK_FILENAME), dtype=np.bool_, mode="w+", shape=shape)
+    mask[rows, cols] = True
+    mask.flush()
+
+    columns = {}
+    for column in output.columns:
+        values = output[column]
+        dtype = values.dtype
+        if dtype == np.bool_:
+            storage_dtype = np.bool_
+        elif np.issubdtype(dtype, np.integer):
+            storage_dtype = np.int64
+        elif np.issubdtype(dtype, np.floating):
+            storage_dtype = np.float64
+        else:
+            raise ValueError("cannot store pipeline column {0} of dtype {1}".format(column, dtype))
+
+        array = np.memmap(
+            os.path.join(path, _column_filename(column)), dtype=storage_dtype, mode="w+", shape=shape)
+        array[rows, cols] = values.values
+        array.flush()
+        columns[column] = str(np.dtype(dtype))
+
+    meta = {
+        "dates": [date.isoformat() for date in unique_dates],
+        "sids": unique_sids.tolist(),
+        "columns": columns,
+        "start_date": unique_dates[0].date().isoformat() if len(unique_dates) else None,
+        "end_date": unique_dates[-1].date().isoformat() if len(unique_dates) else None,
+        "pipeline": pipeline_fingerprint(pipeline) if pipeline is not None else None,
+    }
+    with open(os.path.join(path, META_FILENAME), "w") as f:
+        json.dump(meta, f)
+
+class PipelineCache(object):
+    """
+    Read-only view of precomputed pipeline output.
+
+    Parameters
+    ----------
+    path : str
+        directory written by precompute_pipeline
+
+    sid_to_asset : callable, optional
+        maps integer sids to Asset objects for the output index (default
+        zipline.api.sid, available while an algorithm is running)
+    """
+
+    def __init__(self, path, sid_to_asset=None):
+        with open(os.path.join(path, META_FILENAME)) as f:
+            meta = json.load(f)
+
+        self.path = path
+        self.dates = pd.DatetimeIndex(meta["dates"])
+        self._date_rows = {date.date(): i for i, date in enumerate(self.dates)}
+        self.sids = np.array(meta["sids"], dtype=np.int64)
+        self.columns = meta["columns"]
+        self.start_date = meta.get("start_date")
+        self.end_date = meta.get("end_date")
+        self.pipeline = meta.get("pipeline")
+        shape = _storage_shape(len(self.dates), len(self.sids))
+
+        self._mask = np.memmap(os.path.join(path, MASK_FILENAME), dtype=np.bool_, mode="r", shape=shape)
+        self._arrays = {}
+        for column, dtype in self.columns.items():
+            dtype = np.dtype(dtype)
+            if dtype == np.bool_:
+                storage_dtype = np.bool_
+            elif np.issubdtype(dtype, np.integer):
+                storage_dtype = np.int64
+            else:
+                storage_dtype = np.float64
+            self._arrays[column] = np.memmap(
+                os.path.join(path, _column_filename(column)), dtype=storage_dtype, mode="r", shape=shape)
+
+        self._sid_to_asset = sid_to_asset
+        self._assets = None
+
+    def check(self, pipeline=None, start_date=None, end_date=None):
+        """
+        Raises ValueError if the cache was computed for a different pipeline
+        or doesn't cover start_date to end_date.
+        """
+        if pipeline is not None and self.pipeline != pipeline_fingerprint(pipeline):
+            raise ValueError(
+                "pipeline cache {0} was computed for a different pipeline definition, "
+                "please re-run precompute_pipeline".format(self.path))
+
+        for date in (start_date, end_date):
+            if date is None:
+                continue
+            date = pd.Timestamp(date).date().isoformat()
+            if not self.start_date or not (self.start_date <= date <= self.end_date):
+                raise ValueError(
+                    "pipeline cache {0} covers {1} to {2}, which doesn't include {3}, "
+                    "please re-run precompute_pipeline".format(
+                        self.path, self.start_date, self.end_date, date))
+
+    @property
+    def assets(self):
+        if self._assets is None:
+            sid_to_asset = self._sid_to_asset
+            if sid_to_asset is None:
+                from zipline.api import sid as sid_to_asset
+            self._assets = np.array([sid_to_asset(sid) for sid in self.sids], dtype=object)
+        return self._assets
+
+    def output(self, date):
+        """
+        Returns the pipeline output for date, shaped like pipeline_output().
+        """
+        try:
+            row = self._date_rows[pd.Timestamp(date).date()]
+        except KeyError:
+            raise KeyError("no precomputed pipeline output for {0} (cache covers {1} to {2})".format(
+                pd.Timestamp(date).date(), self.start_date, self.end_date))
+
+        mask = self._mask[row, :len(self.sids)]
+        data = {
+            column: self._arrays[column][row, :len(self.sids)][mask].astype(dtype)
+            for column, dtype in self.columns.items()}
+        return pd.DataFrame(data, index=self.assets[mask])
+
+def load_pipeline_cache(path, pipeline=None, start_date=None, end_date=None):
+    """
+    Returns a PipelineCache for path, or None if path is not set or nothing
+    has been precomputed there.
+
+    If pipeline, start_date or end_date are given, raises ValueError if the
+    cache was computed for a different pipeline or doesn't cover the dates.
+    """
+    if not path or not os.path.exists(os.path.join(path, META_FILENAME)):
+        return None
+    cache = PipelineCache(path)
+    cache.check(pipeline, start_date, end_date)
+    return cache
@@ -0,0 +1,250 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Point-in-time index of Reuters financials for pipeline factors such as
+PriceBookRatio in high_minus_low.py.
+
+Instead of forward-filling the sparse quarterly/annual filings onto every
+trading day for every asset, PointInTimeFundamentals stores each filing once,
+sorted by (asset, availability date), and answers "what was the latest
+value known before this date" for the whole universe with a single binary
+search. Memory grows with the number of filings rather than with
+days x assets.
+
+A filing only becomes visible on the session after its SourceDate, since a
+pipeline computed on a session may only use data known before that
+session (the same reason EquityPricingLoader shifts prices by one session).
+
+PointInTimeFundamentalsLoader wraps the index as a zipline pipeline loader
+for ReutersFinancials columns, so only the dates a pipeline actually
+requests are materialized. make_pipeline_engine builds a pipeline engine
+for a bundle that routes those columns to the loader.
+
+Usage (high_minus_low.py builds the index once and passes it to the
+make_engine of each pipeline_cache.precompute_pipeline worker):
+
+    index = PointInTimeFundamentals.from_reuters_financials(
+        ["ATOT", "LTLL", "QTCO"], universes="amex-stk", start_date="2000-01-01")
+    engine = make_pipeline_engine("amex-1d", PointInTimeFundamentalsLoader(index))
+"""
+
+import io
+import numpy as np
+import pandas as pd
+
+class PointInTimeFundamentals(object):
+    """
+    Sorted store of fundamental filings answering as-of queries by binary
+    search.
+
+    Parameters
+    ----------
+    filings : DataFrame
+        one row per filing with columns ConId, CoaCode, Amount and SourceDate
+        (the date the filing became available), as returned by
+        download_reuters_financials
+    """
+
+    def __init__(self, filings):
+        filings = filings[["ConId", "CoaCode", "Amount", "SourceDate"]].dropna(
+            subset=["ConId", "CoaCode", "SourceDate"])
+
+        self.sids = np.unique(filings.ConId.values.astype(np.int64))
+        self._fields = {}
+
+        for code, code_filings in filings.groupby("CoaCode"):
+            sids = code_filings.ConId.values.astype(np.int64)
+            days = pd.to_datetime(code_filings.SourceDate).values.astype("datetime64[D]").astype(np.int64)
+            amounts = code_filings.Amount.values.astype(np.float64)
+
+            # Combine asset and availability date into a single sort key, so
+            # each asset's filings form a contiguous, date-sorted segment.
+            # For restated filings with the same availability date, the
+            # stable sort keeps the last one last.
+            sid_positions = np.searchsorted(self.sids, sids)
+            keys = self._make_keys(sid_positions, days)
+            order = np.argsort(keys, kind="stable")
+
+            self._fields[code] = (keys[order], sid_positions[order], amounts[order])
+
+    # Offset between assets in the combined sort key; larger than any day
+    # number we will ever see (days since 1970 are < 2**20 until year 4840)
+    _SID_STRIDE = np.int64(1 << 20)
+
+    @classmethod
+    def _make_keys(cls, sid_positions, days):
+        return sid_positions.astype(np.int64) * cls._SID_STRIDE + days
+
+    @classmethod
+    def from_reuters_financials(cls, codes, **kwargs):
+        """
+        Downloads Reuters financials and builds the index.
+
+        Parameters
+        ----------
+        codes : list of str
+            the COA codes to load (e.g. ["ATOT", "LTLL", "QTCO"])
+
+        kwargs :
+            passed to quantrocket.fundamental.download_reuters_financials
+            (e.g. conids, universes, start_date, end_date, interim)
+        """
+        from quantrocket.fundamental import download_reuters_financials
+
+        f = io.StringIO()
+        download_reuters_financials(codes, f, **kwargs)
+        f.seek(0)
+        return cls(pd.read_csv(f, parse_dates=["SourceDate"]))
+
+    @property
+    def codes(self):
+        return list(self._fields)
+
+    def __len__(self):
+        return sum(len(keys) for keys, _, _ in self._fields.values())
+
+    def asof(self, code, date, sids):
+        """
+        Returns the latest value of code known before date for each sid,
+        i.e. from filings with a SourceDate before date (NaN if the sid had
+        no such filing).
+
+        Parameters
+        ----------
+        code : str
+            COA code
+
+        date : str or Timestamp
+            the as-of date
+
+        sids : array-like of int
+            the ConIds to query
+
+        Returns
+        -------
+        ndarray of float64
+        """
+        return self.asof_many(code, [date], sids)[0]
+
+    def asof_many(self, code, dates, sids):
+        """
+        Returns a (len(dates), len(sids)) array of the latest value of code
+        known before each date for each sid.
+        """
+        keys, key_sids, amounts = self._fields[code]
+
+        sids = np.asarray(sids, dtype=np.int64)
+        days = pd.DatetimeIndex(dates).values.astype("datetime64[D]").astype(np.int64)
+
+        sid_positions = np.searchsorted(self.sids, sids)
+        sid_positions = np.clip(sid_positions, 0, max(len(self.sids) - 1, 0))
+        known = (self.sids[sid_positions] == sids) if len(self.sids) else np.zeros(len(sids), dtype=bool)
+
+        # one vectorized binary search for every (date, sid); searching
+        # left of the query key excludes filings made on the date itself
+        query_keys = self._make_keys(sid_positions[None, :], days[:, None])
+        positions = np.searchsorted(keys, query_keys, side="left") - 1
+
+        # a hit is only valid if it belongs to the same asset
+        valid = (positions >= 0) & known[None, :]
+        positions = np.clip(positions, 0, None)
+        if len(keys):
+            valid &= key_sids[positions] == sid_positions[None, :]
+        else:
+            valid[:] = False
+
+        out = np.full(positions.shape, np.nan)
+        out[valid] = amounts[positions[valid]]
+        return out
+
+class PointInTimeFundamentalsLoader(object):
+    """
+    Zipline pipeline loader that serves ReutersFinancials columns from a
+    PointInTimeFundamentals index.
+
+    Parameters
+    ----------
+    index : PointInTimeFundamentals
+        the filings index
+
+    sid_to_conid : callable, optional
+        maps zipline sids to ConIds (default identity, which holds for
+        QuantRocket bundles)
+    """
+
+    def __init__(self, index, sid_to_conid=None):
+        self.index = index
+        self.sid_to_conid = sid_to_conid
+
+    def load_adjusted_array(self, columns, dates, sids, mask):
+        from zipline.lib.adjusted_array import AdjustedArray
+
+        conids = np.asarray(sids, dtype=np.int64)
+        if self.sid_to_conid is not None:
+            conids = np.array([self.sid_to_conid(sid) for sid in sids], dtype=np.int64)
+
+        out = {}
+        for column in columns:
+            values = self.index.asof_many(column.name, dates, conids)
+            out[column] = AdjustedArray(
+                values.astype(column.dtype),
+                mask,
+                adjustments={},
+                missing_value=column.missing_value,
+            )
+        return out
+
+def make_pipeline_engine(bundle, fundamentals_loader, calendar_name="NYSE"):
+    """
+    Returns a pipeline engine for an ingested bundle that loads pricing
+    columns from the bundle and fundamentals columns from
+    fundamentals_loader.
+
+    Parameters
+    ----------
+    bundle : str
+        the bundle name
+
+    fundamentals_loader : PointInTimeFundamentalsLoader
+        loader for columns named like the COA codes in its index (e.g.
+        ReutersFinancials.ATOT)
+
+    calendar_name : str
+        the bundle's trading calendar (default NYSE)
+
+    Returns
+    -------
+    SimplePipelineEngine
+    """
+    from zipline.data import bundles
+    from zipline.pipeline.data import USEquityPricing
+    from zipline.pipeline.engine import SimplePipelineEngine
+    from zipline.pipeline.loaders import USEquityPricingLoader
+    from zipline.utils.calendars import get_calendar
+
+    bundle_data = bundles.load(bundle)
+    pricing_loader = USEquityPricingLoader(
+        bundle_data.equity_daily_bar_reader, bundle_data.adjustment_reader)
+    codes = set(fundamentals_loader.index.codes)
+
+    def get_loader(column):
+        if column in USEquityPricing.columns:
+            return pricing_loader
+        if column.name in codes:
+            return fundamentals_loader
+        raise ValueError("no pipeline loader for column {0}".format(column))
+
+    return SimplePipelineEngine(
+        get_loader, get_calendar(calendar_name).all_sessions, bundle_data.asset_finder)
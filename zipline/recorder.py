@@ -0,0 +1,236 @@
+# Copyright 2018 QuantRocket LLC - All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compact columnar recorder for high-frequency record() calls.
+
+Calling zipline's record() every minute stores each bar's values in a dict
+that is later turned into the performance DataFrame. ColumnarRecorder
+instead writes values into preallocated float64 column arrays. When the
+buffer fills up it is spilled to .npy files (read back memory-mapped) if a
+path was given, or grown otherwise. Values can optionally be downsampled on
+the fly to one row per day:
+
+- "last": the last value of each variable per day
+- "ohlc": the open, high, low and close of each variable per day
+
+Days are calendar days in the given timezone (UTC by default), or trading
+sessions if a session_label function is given, such as the trading
+calendar's minute_to_session_label. For futures like ES, whose sessions
+span two calendar days, pass session_label so that one session isn't split
+in two.
+
+Usage, in a minute algorithm:
+
+    def initialize(context):
+        context.recorder = ColumnarRecorder(
+            path="/codeload/zipline/recorded", downsample="ohlc",
+            session_label=context.trading_calendar.minute_to_session_label)
+
+    def handle_data(context, data):
+        context.recorder.record(get_datetime(), current_price=..., short_mavg=...)
+
+    def analyze(context, perf):
+        context.recorder.to_frame().to_csv("/codeload/zipline/recorded/ohlc.csv")
+"""
+
+import glob
+import os
+import numpy as np
+import pandas as pd
+
+DOWNSAMPLE_METHODS = (None, "last", "ohlc")
+
+class ColumnarRecorder(object):
+    """
+    Records variables into typed column arrays.
+
+    Parameters
+    ----------
+    path : str, optional
+        directory to spill full buffers to. If omitted, the buffer grows in
+        memory instead.
+
+    capacity : int
+        number of rows to buffer before spilling or growing (default 10000)
+
+    downsample : str, optional
+        "last" or "ohlc" to keep one row per day (default None, keep every
+        record call)
+
+    timezone : str
+        timezone whose calendar days are used when downsampling (default
+        UTC)
+
+    session_label : callable, optional
+        function mapping a timestamp to its trading session label, used
+        instead of calendar days when downsampling
+    """
+
+    def __init__(self, path=None, capacity=10000, downsample=None, timezone="UTC",
+                 session_label=None):
+        if downsample not in DOWNSAMPLE_METHODS:
+            raise ValueError("downsample must be one of {0}".format(DOWNSAMPLE_METHODS))
+
+        self.path = path
+        self.capacity = capacity
+        self.downsample = downsample
+        self.timezone = timezone
+        self.session_label = session_label
+
+        self._index = np.empty(capacity, dtype=np.int64)
+        self._columns = {}
+        self._size = 0
+        self._num_spills = 0
+        self._last = {}
+
+        # running values for the current day when downsampling
+        self._day = None
+        self._day_values = {}
+
+        if path:
+            os.makedirs(path, exist_ok=True)
+            # remove chunks left over from a previous run
+            for filename in glob.glob(os.path.join(path, "chunk_*.npy")):
+                os.remove(filename)
+
+    def last(self):
+        """
+        Returns the most recently recorded value of each variable.
+        """
+        return dict(self._last)
+
+    def record(self, dt, **values):
+        """
+        Records values for dt.
+        """
+        self._last.update(values)
+
+        if not self.downsample:
+            self._append(pd.Timestamp(dt).value, values)
+            return
+
+        day = self._day_label(dt)
+        if self._day is not None and day != self._day:
+            self._emit_day()
+        self._day = day
+
+        for name, value in values.items():
+            if self.downsample == "last":
+                self._day_values[name] = value
+                continue
+
+            ohlc = self._day_values.get(name)
+            if ohlc is None:
+                self._day_values[name] = [value, value, value, value]
+            else:
+                if value > ohlc[1]:
+                    ohlc[1] = value
+                if value < ohlc[2]:
+                    ohlc[2] = value
+                ohlc[3] = value
+
+    def _day_label(self, dt):
+        dt = pd.Timestamp(dt)
+        if self.session_label is not None:
+            return pd.Timestamp(self.session_label(dt)).value
+        if dt.tz is None:
+            dt = dt.tz_localize("UTC")
+        # label the day with its date at midnight UTC, like session labels
+        return pd.Timestamp(dt.tz_convert(self.timezone).date()).value
+
+    def _day_row(self):
+        """
+        Returns the downsampled values of the current day.
+        """
+        if self.downsample == "last":
+            return dict(self._day_values)
+        values = {}
+        for name, ohlc in self._day_values.items():
+            for suffix, value in zip(("open", "high", "low", "close"), ohlc):
+                values["{0}_{1}".format(name, suffix)] = value
+        return values
+
+    def _emit_day(self):
+        self._append(self._day, self._day_row())
+        self._day_values = {}
+
+    def _append(self, timestamp, values):
+        if self._size == len(self._index):
+            if self.path:
+                self.spill()
+            else:
+                self._grow()
+
+        row = self._size
+        self._index[row] = timestamp
+        for name, value in values.items():
+            column = self._columns.get(name)
+            if column is None:
+                column = np.full(len(self._index), np.nan)
+                self._columns[name] = column
+            column[row] = value
+        self._size += 1
+
+    def _grow(self):
+        new_capacity = len(self._index) * 2
+        self._index = np.resize(self._index, new_capacity)
+        for name, column in self._columns.items():
+            grown = np.full(new_capacity, np.nan)
+            grown[:self._size] = column[:self._size]
+            self._columns[name] = grown
+
+    def spill(self):
+        """
+        Writes the buffered rows to disk and clears the buffer.
+        """
+        if not self.path or not self._size:
+            return
+
+        prefix = os.path.join(self.path, "chunk_{0:05d}".format(self._num_spills))
+        np.save(prefix + ".index.npy", self._index[:self._size])
+        for name, column in self._columns.items():
+            np.save("{0}.{1}.npy".format(prefix, name), column[:self._size])
+            column[:self._size] = np.nan
+
+        self._num_spills += 1
+        self._size = 0
+
+    def to_frame(self):
+        """
+        Returns all recorded rows, including spilled ones and the current
+        day when downsampling, as a DataFrame.
+        """
+        frames = []
+        for i in range(self._num_spills):
+            prefix = os.path.join(self.path, "chunk_{0:05d}".format(i))
+            index = np.load(prefix + ".index.npy", mmap_mode="r")
+            columns = {}
+            for filename in glob.glob(prefix + ".*.npy"):
+                name = filename[len(prefix) + 1:-len(".npy")]
+                if name != "index":
+                    columns[name] = np.load(filename, mmap_mode="r")
+            frames.append(pd.DataFrame(columns, index=pd.to_datetime(index, utc=True)))
+
+        frames.append(pd.DataFrame(
+            {name: column[:self._size] for name, column in self._columns.items()},
+            index=pd.to_datetime(self._index[:self._size], utc=True)))
+
+        if self.downsample and self._day_values:
+            # the current day is still open, so show it without emitting it
+            frames.append(pd.DataFrame(
+                self._day_row(), index=pd.to_datetime([self._day], utc=True)))
+
+        frame = pd.concat(frames, sort=False) if len(frames) > 1 else frames[0]
+        return frame[sorted(frame.columns)]
@@ -18,6 +18,8 @@ from zipline.api import (
     order_target_percent,
     get_open_orders,
     cancel_order,
+    get_datetime,
+    get_environment,
     pipeline_output,
     record,
     schedule_function,
@@ -46,6 +48,10 @@ MOMENTUM_WINDOW = 252
 RANKING_PERIOD_GAP = 22
 TOP_N_DECILES = 5
 REBALANCE_INTERVAL = date_rules.month_start()
+# Directory of pipeline output precomputed with
+# pipeline_cache.precompute_pipeline, or None to compute the pipeline
+# during the backtest
+PIPELINE_CACHE_DIR = None
 
 class Momentum(CustomFactor):
     """
@@ -109,7 +115,16 @@ def rebalance(context, data):
 
 
 def initialize(context):
-    attach_pipeline(make_pipeline(), 'my_pipeline')
+    pipeline = make_pipeline()
+    attach_pipeline(pipeline, 'my_pipeline')
+
+    context.pipeline_cache = None
+    if PIPELINE_CACHE_DIR:
+        from codeload.zipline.pipeline_cache import load_pipeline_cache
+        # fails if the cache is stale or doesn't cover the backtest
+        context.pipeline_cache = load_pipeline_cache(
+            PIPELINE_CACHE_DIR, pipeline,
+            get_environment('start'), get_environment('end'))
 
     # If Zipline has trouble pulling the default benchmark, try setting the
     # benchmark to something already in your bundle
@@ -122,4 +137,7 @@ def initialize(context):
 
 
 def before_trading_start(context, data):
-    context.pipeline_data = pipeline_output('my_pipeline')
+    if context.pipeline_cache is not None:
+        context.pipeline_data = context.pipeline_cache.output(get_datetime())
+    else:
+        context.pipeline_data = pipeline_output('my_pipeline')